@@ -0,0 +1,38 @@
+# Rendering dei grafici, eseguito nei processi del pool.
+# Con il contesto 'spawn' ogni processo reimporta anche lo script principale come __mp_main__:
+# per questo crypto2 rimanda database, scheduler e import pesanti a main().
+from io import BytesIO
+
+def _pyplot():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def _to_png(plt, fig):
+    output = BytesIO()
+    fig.savefig(output, format='png', dpi=100, bbox_inches='tight')
+    plt.close(fig)
+    return output.getvalue()
+
+def render_allocation_chart(labels, values):
+    plt = _pyplot()
+    fig, ax = plt.subplots(figsize=(6, 6))
+    ax.pie(values, labels=labels, autopct='%1.1f%%', startangle=90, counterclock=False)
+    ax.set_title('Allocazione del portafoglio')
+    ax.axis('equal')
+    return _to_png(plt, fig)
+
+def render_value_chart(dates, values, costs):
+    from datetime import date
+    plt = _pyplot()
+    days = [date.fromisoformat(day) for day in dates]
+    fig, ax = plt.subplots(figsize=(8, 4.5))
+    ax.plot(days, values, label='Valore', linewidth=2)
+    ax.plot(days, costs, label='Costo', linestyle='--')
+    ax.set_title('Valore del portafoglio nel tempo')
+    ax.set_ylabel('USD')
+    ax.grid(True, alpha=0.3)
+    ax.legend()
+    fig.autofmt_xdate()
+    return _to_png(plt, fig)
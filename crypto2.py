@@ -1,37 +1,103 @@
 import os
-import telebot
-import sqlite3
-from datetime import datetime, timedelta
-import requests
-from dotenv import load_dotenv
-import locale
-from apscheduler.schedulers.background import BackgroundScheduler
-import pandas as pd
-from io import BytesIO
+import sys
+import importlib.util
+from contextlib import contextmanager
+from time import monotonic, perf_counter, sleep
 
-# Caricamento delle variabili d'ambiente
-load_dotenv()
+STARTED_AT = perf_counter()
+startup_timings = []
+
+@contextmanager
+def startup_phase(label):
+    """Registra la durata di una fase dell'avvio per il report finale."""
+    started = perf_counter()
+    yield
+    startup_timings.append((label, perf_counter() - started))
+
+def lazy_import(name):
+    """Modulo caricato davvero solo al primo accesso a un suo attributo."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
-locale.setlocale(locale.LC_ALL, '')
+with startup_phase('import telebot'):
+    # telebot usa già requests, quindi importarlo qui non aggiunge costo
+    import telebot
+    from telebot.apihelper import ApiTelegramException
+    import requests
+with startup_phase('import dotenv'):
+    from dotenv import load_dotenv
+with startup_phase('import stdlib'):
+    import sqlite3
+    from datetime import datetime, timedelta
+    import locale
+    from io import BytesIO
+    import threading
+    from collections import namedtuple, OrderedDict
+    from functools import lru_cache
+    import hashlib
+    import bisect
+    import queue
+    import random
+with startup_phase('import charts'):
+    import charts
+
+# numpy serve solo dal primo tick; pandas/openpyxl e apscheduler vengono importati dove servono
+np = lazy_import('numpy')
+
+# Caricamento delle variabili d'ambiente
+with startup_phase('load .env'):
+    load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 CMC_API_KEY = os.getenv('CMC_API_KEY')
 AUTHORIZED_USER_ID = int(os.getenv('AUTHORIZED_USER_ID'))
 
+# Sorgente dei tick di prezzo per gli alert: 'poll' (CoinMarketCap) oppure 'simulated' (solo per test)
+ALERT_FEEDS = {feed.strip() for feed in os.getenv('ALERT_FEED', 'poll').split(',')}
+ALERT_FEED_NAMES = ('poll', 'simulated')
+# Nei gruppi Telegram accetta circa 20 modifiche al minuto per chat
+LIVE_MIN_EDIT_SECONDS = 3
+# Intervallo dell'aggiornamento condiviso dei prezzi, usato dagli alert e dai messaggi /live:
+# ogni messaggio live viene modificato al massimo una volta per aggiornamento
+ALERT_POLL_SECONDS = max(float(os.getenv('ALERT_POLL_SECONDS', '300')), LIVE_MIN_EDIT_SECONDS)
+PRICE_CACHE_SECONDS = min(30, ALERT_POLL_SECONDS / 2)
+ALERT_SIMULATED_SECONDS = float(os.getenv('ALERT_SIMULATED_SECONDS', '1'))
+ALERT_MAX_LATENCY = 1.0
+ALERT_REFERENCE_SAVE_SECONDS = 60
+
 # Inizializzazione del bot
-bot = telebot.TeleBot(TELEGRAM_TOKEN)
+with startup_phase('bot'):
+    bot = telebot.TeleBot(TELEGRAM_TOKEN)
+scheduler = None
+first_response_logged = False
 
 def is_authorized(message):
     return message.from_user.id == AUTHORIZED_USER_ID
 
 def authorized_only(func):
     def wrapper(message):
+        log_first_response()
         if is_authorized(message):
             return func(message)
         else:
             bot.reply_to(message, "Non sei autorizzato ad utilizzare questo bot.")
     return wrapper
 
+def log_first_response():
+    global first_response_logged
+    if not first_response_logged:
+        first_response_logged = True
+        print(f"Primo messaggio gestito {perf_counter() - STARTED_AT:.2f}s dopo l'avvio")
+
 # Funzioni di utilità per il database
 def get_db_connection():
     conn = sqlite3.connect('crypto_tracker.db')
@@ -56,8 +122,17 @@ def init_db():
      user_id INTEGER,
      crypto TEXT,
      target_price REAL,
-     is_above BOOLEAN)
+     is_above BOOLEAN,
+     alert_type TEXT DEFAULT 'price',
+     reference_price REAL)
     ''')
+    # Aggiornamento dei database creati prima dei nuovi tipi di alert
+    cursor.execute("PRAGMA table_info(price_alerts)")
+    alert_columns = {column['name'] for column in cursor.fetchall()}
+    if 'alert_type' not in alert_columns:
+        cursor.execute("ALTER TABLE price_alerts ADD COLUMN alert_type TEXT DEFAULT 'price'")
+    if 'reference_price' not in alert_columns:
+        cursor.execute("ALTER TABLE price_alerts ADD COLUMN reference_price REAL")
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS scheduled_reports
     (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -65,13 +140,76 @@ def init_db():
      time TEXT,
      frequency TEXT)
     ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS price_history
+    (crypto TEXT,
+     date DATE,
+     price REAL,
+     PRIMARY KEY (crypto, date))
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS transactions_archive
+    (id INTEGER PRIMARY KEY,
+     user_id INTEGER,
+     crypto TEXT,
+     quantity REAL,
+     price REAL,
+     date DATE)
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS opening_balances
+    (user_id INTEGER,
+     crypto TEXT,
+     quantity REAL,
+     cost REAL,
+     first_purchase_date DATE,
+     last_archived_date DATE,
+     PRIMARY KEY (user_id, crypto))
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user ON transactions (user_id, crypto, date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_transactions_archive_user ON transactions_archive (user_id, crypto, date)")
+    # Saldi: transazioni recenti più i saldi di apertura delle transazioni archiviate
+    cursor.execute('''
+    CREATE VIEW IF NOT EXISTS holdings_ledger AS
+    SELECT user_id, crypto, quantity, quantity * price AS cost, date AS first_date, date AS last_date FROM transactions
+    UNION ALL
+    SELECT user_id, crypto, quantity, cost, first_purchase_date, last_archived_date FROM opening_balances
+    ''')
+    # Storico completo: transazioni recenti e archiviate
+    cursor.execute('''
+    CREATE VIEW IF NOT EXISTS all_transactions AS
+    SELECT id, user_id, crypto, quantity, price, date FROM transactions
+    UNION ALL
+    SELECT id, user_id, crypto, quantity, price, date FROM transactions_archive
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS live_messages
+    (chat_id INTEGER PRIMARY KEY,
+     user_id INTEGER,
+     message_id INTEGER,
+     content_hash TEXT)
+    ''')
     conn.commit()
     conn.close()
 
-# Inizializzazione del database
-init_db()
+# Versione delle transazioni di ogni utente, usata come chiave della cache dei grafici
+transaction_versions = {}
+
+def mark_transactions_changed(user_id):
+    transaction_versions[user_id] = transaction_versions.get(user_id, 0) + 1
+    reload_portfolio_holdings(user_id)
 
 # Funzioni di utilità
+def record_prices(prices):
+    """Salva l'ultimo prezzo del giorno di ogni simbolo, usato per i grafici storici."""
+    today = datetime.now().date()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany("INSERT OR REPLACE INTO price_history (crypto, date, price) VALUES (?, ?, ?)",
+                       [(crypto, today, price) for crypto, price in prices.items()])
+    conn.commit()
+    conn.close()
+
 def get_current_price(crypto):
     url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest'
     parameters = {
@@ -88,7 +226,9 @@ def get_current_price(crypto):
         data = response.json()
         
         if response.status_code == 200:
-            return data['data'][crypto]['quote']['USD']['price'], data['data'][crypto]['quote']['USD']['percent_change_24h']
+            quote = data['data'][crypto]['quote']['USD']
+            record_prices({crypto: quote['price']})
+            return quote['price'], quote['percent_change_24h']
         else:
             print(f"Errore nell'ottenere il prezzo per {crypto}: {data['status']['error_message']}")
             return None, None
@@ -96,10 +236,53 @@ def get_current_price(crypto):
         print(f"Errore nella richiesta API per {crypto}: {e}")
         return None, None
 
+price_cache = {}
+
+def price_snapshot(cryptos):
+    """Istante dell'ultima lettura dei prezzi in cache per questi simboli."""
+    return max((price_cache[crypto][0] for crypto in cryptos if crypto in price_cache), default=0)
+
+def get_current_prices(cryptos):
+    """Prezzi attuali di più simboli con una sola richiesta API; i prezzi recenti vengono riusati."""
+    now = monotonic()
+    cached = {crypto: price_cache[crypto][1] for crypto in cryptos
+              if crypto in price_cache and now - price_cache[crypto][0] < PRICE_CACHE_SECONDS}
+    cryptos = set(cryptos) - set(cached)
+    if not cryptos:
+        return cached
+    url = 'https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest'
+    parameters = {
+        'symbol': ','.join(sorted(cryptos)),
+        'convert': 'USD',
+        'skip_invalid': 'true'
+    }
+    headers = {
+        'Accepts': 'application/json',
+        'X-CMC_PRO_API_KEY': CMC_API_KEY,
+    }
+
+    try:
+        response = requests.get(url, params=parameters, headers=headers)
+        data = response.json()
+
+        if response.status_code == 200:
+            prices = {crypto: (quote['quote']['USD']['price'], quote['quote']['USD']['percent_change_24h'])
+                      for crypto, quote in data['data'].items()}
+            record_prices({crypto: price for crypto, (price, _) in prices.items()})
+            price_cache.update((crypto, (now, quote)) for crypto, quote in prices.items())
+            return {**cached, **prices}
+        else:
+            print(f"Errore nell'ottenere i prezzi per {parameters['symbol']}: {data['status']['error_message']}")
+            return cached
+    except Exception as e:
+        print(f"Errore nella richiesta API per {parameters['symbol']}: {e}")
+        return cached
+
 # Funzioni per l'importazione/esportazione Excel
 def export_transactions_to_excel(user_id):
+    import pandas as pd
     conn = get_db_connection()
-    query = "SELECT crypto, quantity, price, date FROM transactions WHERE user_id = ?"
+    query = "SELECT crypto, quantity, price, date FROM all_transactions WHERE user_id = ? ORDER BY date"
     df = pd.read_sql_query(query, conn, params=(user_id,))
     conn.close()
     
@@ -110,6 +293,7 @@ def export_transactions_to_excel(user_id):
     return output
 
 def import_transactions_from_excel(user_id, file):
+    import pandas as pd
     df = pd.read_excel(file)
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -122,6 +306,366 @@ def import_transactions_from_excel(user_id, file):
     conn.close()
     return len(df)
 
+# Modello del portafoglio e rendering delle risposte
+class PortfolioRow:
+    """Posizione aggregata di un simbolo con il prezzo attuale: una sola computazione per tutte le viste."""
+    __slots__ = ('crypto', 'quantity', 'cost', 'first_purchase_date', 'quantity_7_days_ago',
+                 'price', 'percent_change_24h', 'value', 'profit_loss', 'profit_loss_percentage',
+                 'today', 'value_24h_ago', 'value_7_days_ago')
+
+    def __init__(self, crypto, quantity, cost, first_purchase_date, quantity_7_days_ago, price, percent_change_24h, today):
+        self.crypto = crypto
+        self.quantity = quantity
+        self.cost = cost
+        self.first_purchase_date = first_purchase_date
+        self.quantity_7_days_ago = quantity_7_days_ago
+        self.price = price
+        self.percent_change_24h = percent_change_24h
+        self.today = today
+        if price is None:
+            self.value = self.profit_loss = self.profit_loss_percentage = None
+            self.value_24h_ago = self.value_7_days_ago = None
+        else:
+            self.value = quantity * price
+            self.profit_loss = self.value - cost
+            self.profit_loss_percentage = (self.profit_loss / cost) * 100 if cost else 0
+            self.value_24h_ago = self.value / (1 + percent_change_24h / 100)
+            self.value_7_days_ago = quantity_7_days_ago * price
+
+    @property
+    def days_held(self):
+        # Letta solo da /balance e /live: una data salvata in un formato diverso non deve rompere le altre viste
+        try:
+            first_purchase_date = datetime.strptime(str(self.first_purchase_date)[:10], '%Y-%m-%d').date()
+        except ValueError:
+            return 'n/d'
+        return (self.today - first_purchase_date).days
+
+def load_portfolio(user_id, prices=None):
+    """Posizioni dell'utente con una sola query e una sola richiesta di prezzi (o con i prezzi già letti)."""
+    today = datetime.now().date()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+    SELECT crypto, 
+           SUM(quantity) as total_quantity, 
+           SUM(cost) as total_cost,
+           MIN(first_date) as first_purchase_date,
+           SUM(CASE WHEN last_date <= ? THEN quantity ELSE 0 END) as quantity_7_days_ago
+    FROM holdings_ledger 
+    WHERE user_id = ?
+    GROUP BY crypto
+    """, (today - timedelta(days=7), user_id))
+    results = cursor.fetchall()
+    conn.close()
+
+    if prices is None:
+        prices = get_current_prices([result['crypto'] for result in results])
+    return [PortfolioRow(result['crypto'], result['total_quantity'], result['total_cost'], result['first_purchase_date'],
+                         result['quantity_7_days_ago'], *prices.get(result['crypto'], (None, None)), today)
+            for result in results]
+
+@lru_cache(maxsize=1024)
+def escape_markdown(text):
+    # Caratteri speciali del Markdown legacy di Telegram
+    return text.replace('\\', '\\\\').replace('_', '\\_').replace('*', '\\*').replace('`', '\\`').replace('[', '\\[')
+
+# Template precompilati: le parti fisse sono già valide in Markdown, i simboli vengono escapati
+BALANCE_HEADER = "📊 *Il tuo Portafoglio Crypto*\n\n"
+BALANCE_ROW = ("*{crypto}*:\n"
+               "Quantità: {row.quantity:.4f}\n"
+               "Valore attuale: ${row.value:.2f}\n"
+               "Prezzo attuale: ${row.price:.2f}\n"
+               "Variazione 24h: {row.percent_change_24h:.2f}%\n"
+               "P/L: ${row.profit_loss:.2f} ({row.profit_loss_percentage:.2f}%)\n"
+               "Giorni di detenzione: {row.days_held}\n\n").format
+BALANCE_FOOTER = ("*📈 Performance totale del portafoglio*:\n"
+                  "*Valore totale: ${value:.2f}*\n"
+                  "Costo totale: ${cost:.2f}\n"
+                  "*P/L totale: ${profit_loss:.2f} ({profit_loss_percentage:.2f}%)*\n").format
+
+PROFIT_HEADER = "Profitto/Perdita:\n\n"
+PROFIT_ROW = ("{row.crypto}:\n"
+              "  Profitto/Perdita: ${row.profit_loss:.2f}\n"
+              "  Percentuale: {row.profit_loss_percentage:+.2f}%\n\n").format
+PROFIT_FOOTER = "Profitto/Perdita totale: ${:.2f}".format
+
+WEEKLY_HEADER = "Confronto con 7 giorni fa:\n\n"
+WEEKLY_ROW = ("{row.crypto}:\n"
+              "  7 giorni fa: {row.quantity_7_days_ago:.4f} (${row.value_7_days_ago:.2f})\n"
+              "  Oggi: {row.quantity:.4f} (${row.value:.2f})\n"
+              "  Differenza: ${difference:.2f} ({difference_percentage:+.2f}%)\n\n").format
+
+HISTORY_HEADER = "Storico delle transazioni per {}:\n\n".format
+HISTORY_ROW = "Data: {date}, Quantità: {quantity:.4f}, Prezzo: ${price:.2f}\n".format
+HISTORY_FOOTER = "\nPrezzo attuale di {}: ${:.2f}".format
+
+REPORT_HEADER = "📊 *Resoconto del tuo Portafoglio*\n\n"
+REPORT_ROW = "*{crypto}*: ${row.value:.2f} (${change:.2f}, {row.percent_change_24h:.2f}%)\n".format
+REPORT_FOOTER = ("\n*Totale: ${value:.2f}*\n"
+                 "Variazione 24h: ${change:.2f} ({change_percentage:.2f}%)").format
+
+PRICE_UNAVAILABLE = "{}: Prezzo non disponibile\n\n".format
+
+def render_balance(rows):
+    priced = [row for row in rows if row.price is not None]
+    value = sum(row.value for row in priced)
+    cost = sum(row.cost for row in priced)
+    profit_loss = value - cost
+    parts = [BALANCE_HEADER]
+    parts.extend(BALANCE_ROW(crypto=escape_markdown(row.crypto), row=row) for row in priced)
+    parts.append(BALANCE_FOOTER(value=value, cost=cost, profit_loss=profit_loss,
+                                profit_loss_percentage=(profit_loss / cost) * 100 if cost else 0))
+    return ''.join(parts)
+
+def render_profit(rows):
+    parts = [PROFIT_HEADER]
+    parts.extend(PRICE_UNAVAILABLE(row.crypto) if row.price is None else PROFIT_ROW(row=row) for row in rows)
+    parts.append(PROFIT_FOOTER(sum(row.profit_loss for row in rows if row.price is not None)))
+    return ''.join(parts)
+
+def render_weekly(rows):
+    parts = [WEEKLY_HEADER]
+    for row in rows:
+        if row.price is None:
+            parts.append(PRICE_UNAVAILABLE(row.crypto))
+            continue
+        difference = row.value - row.value_7_days_ago
+        difference_percentage = (difference / row.value_7_days_ago) * 100 if row.value_7_days_ago != 0 else 0
+        parts.append(WEEKLY_ROW(row=row, difference=difference, difference_percentage=difference_percentage))
+    return ''.join(parts)
+
+def render_history(crypto, transactions, current_price):
+    parts = [HISTORY_HEADER(crypto)]
+    parts.extend(HISTORY_ROW(date=transaction['date'], quantity=transaction['quantity'], price=transaction['price'])
+                 for transaction in transactions)
+    if current_price is not None:
+        parts.append(HISTORY_FOOTER(crypto, current_price))
+    return ''.join(parts)
+
+def render_report(rows):
+    priced = [row for row in rows if row.price is not None]
+    value = sum(row.value for row in priced)
+    value_24h_ago = sum(row.value_24h_ago for row in priced)
+    change = value - value_24h_ago
+    parts = [REPORT_HEADER]
+    parts.extend(REPORT_ROW(crypto=escape_markdown(row.crypto), row=row, change=row.value - row.value_24h_ago)
+                 for row in priced)
+    parts.append(REPORT_FOOTER(value=value, change=change,
+                               change_percentage=(change / value_24h_ago) * 100 if value_24h_ago else 0))
+    return ''.join(parts)
+
+# Messaggi live del portafoglio
+LIVE_EDIT_INTERVAL = 1 / 25
+# Istante prima del quale non modificare la chat, dopo un errore 429 di Telegram
+live_retry_at = {}
+
+def content_hash(text):
+    return hashlib.sha1(text.encode()).hexdigest()
+
+def render_live(rows):
+    return render_balance(rows) if rows else "📊 Non hai ancora aggiunto alcuna transazione."
+
+def get_live_symbols():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT crypto FROM holdings_ledger WHERE user_id IN (SELECT user_id FROM live_messages)")
+    symbols = {row['crypto'] for row in cursor.fetchall()}
+    conn.close()
+    return symbols
+
+def stop_live_message(chat_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT message_id FROM live_messages WHERE chat_id = ?", (chat_id,))
+    live = cursor.fetchone()
+    cursor.execute("DELETE FROM live_messages WHERE chat_id = ?", (chat_id,))
+    conn.commit()
+    conn.close()
+    live_retry_at.pop(chat_id, None)
+
+    if live is not None:
+        try:
+            bot.unpin_chat_message(chat_id, live['message_id'])
+        except ApiTelegramException:
+            pass
+    return live is not None
+
+def refresh_live_messages(prices):
+    """Modifica i messaggi live solo se il contenuto è cambiato, rispettando i limiti di Telegram."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT chat_id, user_id, message_id, content_hash FROM live_messages")
+    lives = cursor.fetchall()
+    conn.close()
+
+    for live in lives:
+        chat_id = live['chat_id']
+        if monotonic() < live_retry_at.get(chat_id, 0):
+            continue
+        rows = load_portfolio(live['user_id'], prices)
+        if any(row.price is None for row in rows):
+            # Prezzi non disponibili (errore di CoinMarketCap): resta il contenuto dell'ultimo aggiornamento riuscito
+            continue
+        text = render_live(rows)
+        digest = content_hash(text)
+        if digest == live['content_hash']:
+            continue
+
+        try:
+            bot.edit_message_text(text, chat_id, live['message_id'], parse_mode='Markdown')
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                # Non bloccare il thread condiviso: la chat verrà ripresa a un aggiornamento successivo
+                live_retry_at[chat_id] = monotonic() + e.result_json.get('parameters', {}).get('retry_after', 1)
+                continue
+            if 'message to edit not found' in e.description:
+                stop_live_message(chat_id)
+                continue
+            if 'message is not modified' not in e.description:
+                print(f"Errore nell'aggiornamento del messaggio live in {chat_id}: {e.description}")
+                continue
+
+        live_retry_at.pop(chat_id, None)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute("UPDATE live_messages SET content_hash = ? WHERE chat_id = ?", (digest, chat_id))
+        conn.commit()
+        conn.close()
+        # Resta sotto il limite globale di circa 30 messaggi al secondo
+        sleep(LIVE_EDIT_INTERVAL)
+
+# Funzioni per i grafici
+CHART_PERIODS = {'7d': 7, '30d': 30, '90d': 90, '1y': 365}
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', '2'))
+CHART_CACHE_SIZE = 64
+
+chart_cache = OrderedDict()
+chart_cache_lock = threading.Lock()
+chart_executor = None
+chart_delivery = None
+
+def get_chart_executor():
+    global chart_executor
+    with chart_cache_lock:
+        if chart_executor is None:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            # 'spawn' evita di duplicare i thread del bot e dello scheduler nei processi figli
+            chart_executor = ProcessPoolExecutor(max_workers=CHART_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return chart_executor
+
+def get_chart(user_id, period, cryptos, render, *data):
+    """Future con i byte PNG del grafico, condiviso finché utente, periodo e dati non cambiano.
+
+    La versione dei dati è data dalle transazioni dell'utente e dalla lettura dei prezzi usata,
+    così il report programmato e /chart condividono il rendering finché la cache dei prezzi è valida.
+    """
+    cryptos = tuple(sorted(cryptos))
+    data_version = (transaction_versions.get(user_id, 0), cryptos, price_snapshot(cryptos), datetime.now().date())
+    key = (user_id, period, data_version)
+    with chart_cache_lock:
+        future = chart_cache.get(key)
+        if future is not None:
+            chart_cache.move_to_end(key)
+            return future
+
+    future = get_chart_executor().submit(render, *data)
+    with chart_cache_lock:
+        # Se un'altra richiesta identica è arrivata prima, usa il suo rendering
+        if key in chart_cache:
+            future.cancel()
+            return chart_cache[key]
+        chart_cache[key] = future
+        while len(chart_cache) > CHART_CACHE_SIZE:
+            chart_cache.popitem(last=False)
+
+    def discard_failed(done):
+        # I rendering falliti non devono restare in cache
+        if done.exception() is not None:
+            with chart_cache_lock:
+                if chart_cache.get(key) is done:
+                    del chart_cache[key]
+
+    future.add_done_callback(discard_failed)
+    return future
+
+def get_allocation_chart(user_id, rows):
+    allocation = sorted((row.crypto, round(row.value, 2)) for row in rows if row.price is not None and row.value > 0)
+    if not allocation:
+        return None
+    labels, values = zip(*allocation)
+    return get_chart(user_id, 'allocation', labels, charts.render_allocation_chart, labels, values)
+
+def get_value_history(user_id, days):
+    """Valore e costo del portafoglio giorno per giorno, con i prezzi storici salvati e quelli delle transazioni."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT crypto, quantity, price, date FROM all_transactions WHERE user_id = ? ORDER BY date", (user_id,))
+    transactions = cursor.fetchall()
+    if not transactions:
+        conn.close()
+        return None
+    symbols = sorted({transaction['crypto'] for transaction in transactions})
+    get_current_prices(symbols)
+    cursor.execute(f"""
+    SELECT crypto, date, price FROM price_history
+    WHERE crypto IN ({','.join('?' * len(symbols))})
+    ORDER BY date
+    """, symbols)
+    history = cursor.fetchall()
+    conn.close()
+    priced = [crypto for crypto in symbols if crypto in price_cache]
+
+    # Prezzi noti per simbolo e per giorno; a parità di giorno vince il prezzo di mercato
+    daily_prices = {crypto: {} for crypto in symbols}
+    for row in list(transactions) + history:
+        daily_prices[row['crypto']][str(row['date'])[:10]] = row['price']
+    known_prices = {}
+    for crypto, by_day in daily_prices.items():
+        dates = sorted(by_day)
+        known_prices[crypto] = (dates, [by_day[date] for date in dates])
+
+    today = datetime.now().date()
+    days_list = [(today - timedelta(days=offset)).isoformat() for offset in range(days - 1, -1, -1)]
+    quantities = dict.fromkeys(symbols, 0)
+    cost = 0
+    position = 0
+    values, costs = [], []
+    for day in days_list:
+        while position < len(transactions) and str(transactions[position]['date'])[:10] <= day:
+            transaction = transactions[position]
+            quantities[transaction['crypto']] += transaction['quantity']
+            cost += transaction['quantity'] * transaction['price']
+            position += 1
+        value = 0
+        for crypto, quantity in quantities.items():
+            dates, prices = known_prices[crypto]
+            index = bisect.bisect_right(dates, day) - 1
+            if quantity and index >= 0:
+                value += quantity * prices[index]
+        values.append(round(value, 2))
+        costs.append(round(cost, 2))
+    return priced, (days_list, values, costs)
+
+def deliver_chart(chat_id, future, caption):
+    try:
+        bot.send_photo(chat_id, future.result(), caption=caption)
+    except Exception as e:
+        try:
+            bot.send_message(chat_id, f"Si è verificato un errore durante la creazione del grafico: {str(e)}")
+        except Exception as send_error:
+            print(f"Errore nell'invio del grafico a {chat_id}: {e} / {send_error}")
+
+def deliver_chart_later(chat_id, future, caption):
+    """Invia il grafico da un thread del bot, senza bloccare il polling né il pool di rendering."""
+    global chart_delivery
+    with chart_cache_lock:
+        if chart_delivery is None:
+            from concurrent.futures import ThreadPoolExecutor
+            chart_delivery = ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix='chart-delivery')
+    chart_delivery.submit(deliver_chart, chat_id, future, caption)
+
 # Handler dei comandi
 @bot.message_handler(commands=['start', 'help'])
 @authorized_only
@@ -137,13 +681,16 @@ def send_welcome(message):
 
     *VISUALIZZA*
     /balance - Mostra il saldo attuale e le performance
+    /live - Messaggio fissato con il portafoglio aggiornato automaticamente (/live stop per disattivarlo)
     /profit - Mostra il profitto/perdita totale
     /weekly - Mostra il confronto con 7 giorni fa
     /history <crypto> - Storico delle transazioni per una criptovaluta
     /debug - Mostra le ultime 20 transazioni nel database
+    /chart - Grafico dell'allocazione del portafoglio
+    /chartvalue <periodo> - Grafico del valore nel tempo (7d, 30d, 90d, 1y)
 
     *IMPOSTAZIONI PER L'ALERT*
-    /setalert - Imposta un avviso di prezzo
+    /setalert - Imposta un avviso (prezzo, variazione %, trailing stop, volatilità, portafoglio)
     /viewalerts - Visualizza gli alert impostati
     /editalert - Modifica un alert esistente
     /deletealert - Elimina un alert esistente
@@ -178,6 +725,7 @@ def process_add_transaction(message):
                        (message.from_user.id, crypto.upper(), quantity, price, date))
         conn.commit()
         conn.close()
+        mark_transactions_changed(message.from_user.id)
         
         bot.reply_to(message, f"Transazione aggiunta con successo: {quantity:.4f} {crypto.upper()} a ${price:.2f} il {date.strftime('%d-%m-%Y')}")
     except ValueError:
@@ -230,6 +778,7 @@ def process_add_multiple_transactions(message):
 
     conn.commit()
     conn.close()
+    mark_transactions_changed(message.from_user.id)
 
     response = f"Transazioni aggiunte con successo: {success_count}"
     if errors:
@@ -243,137 +792,29 @@ def process_add_multiple_transactions(message):
 @bot.message_handler(commands=['balance'])
 @authorized_only
 def show_balance(message):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT crypto, 
-           SUM(quantity) as total_quantity, 
-           SUM(quantity * price) as total_cost,
-           MIN(date) as first_purchase_date
-    FROM transactions 
-    WHERE user_id = ?
-    GROUP BY crypto
-    """, (message.from_user.id,))
-    results = cursor.fetchall()
-    conn.close()
-    
-    if not results:
+    rows = load_portfolio(message.from_user.id)
+    if not rows:
         bot.reply_to(message, "📊 Non hai ancora aggiunto alcuna transazione.")
         return
-    
-    response = "📊 *Il tuo Portafoglio Crypto*\n\n"
-    total_portfolio_value = 0
-    total_portfolio_cost = 0
-    
-    for result in results:
-        crypto = result['crypto']
-        quantity = result['total_quantity']
-        cost = result['total_cost']
-        first_purchase_date = datetime.strptime(result['first_purchase_date'], '%Y-%m-%d').date()
-        current_price, percent_change_24h = get_current_price(crypto)
-        
-        if current_price is not None:
-            current_value = quantity * current_price
-            total_portfolio_value += current_value
-            total_portfolio_cost += cost
-            profit_loss = current_value - cost
-            profit_loss_percentage = (profit_loss / cost) * 100
-            days_held = (datetime.now().date() - first_purchase_date).days
-            
-            response += f"*{crypto}*:\n"
-            response += f"Quantità: {quantity:.4f}\n"
-            response += f"Valore attuale: ${current_value:.2f}\n"
-            response += f"Prezzo attuale: ${current_price:.2f}\n"
-            response += f"Variazione 24h: {percent_change_24h:.2f}%\n"
-            response += f"P/L: ${profit_loss:.2f} ({profit_loss_percentage:.2f}%)\n"
-            response += f"Giorni di detenzione: {days_held}\n\n"
-    
-    total_profit_loss = total_portfolio_value - total_portfolio_cost
-    total_profit_loss_percentage = (total_profit_loss / total_portfolio_cost) * 100
-    
-    response += f"*📈 Performance totale del portafoglio*:\n"
-    response += f"*Valore totale: ${total_portfolio_value:.2f}*\n"
-    response += f"Costo totale: ${total_portfolio_cost:.2f}\n"
-    response += f"*P/L totale: ${total_profit_loss:.2f} ({total_profit_loss_percentage:.2f}%)*\n"
-    
-    bot.reply_to(message, response, parse_mode='Markdown')
+    bot.reply_to(message, render_balance(rows), parse_mode='Markdown')
 
 @bot.message_handler(commands=['profit'])
 @authorized_only
 def show_profit(message):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT crypto, SUM(quantity) as total_quantity, SUM(quantity * price) as total_cost FROM transactions WHERE user_id = ? GROUP BY crypto", (message.from_user.id,))
-    results = cursor.fetchall()
-    conn.close()
-    
-    if not results:
+    rows = load_portfolio(message.from_user.id)
+    if not rows:
         bot.reply_to(message, "Non hai ancora aggiunto alcuna transazione.")
         return
-    
-    total_profit = 0
-    response = "Profitto/Perdita:\n\n"
-    for result in results:
-        crypto = result['crypto']
-        quantity = result['total_quantity']
-        cost = result['total_cost']
-        current_price, _ = get_current_price(crypto)
-        if current_price is not None:
-            current_value = quantity * current_price
-            profit = current_value - cost
-            profit_percentage = (profit / cost) * 100
-            total_profit += profit
-            response += f"{crypto}:\n"
-            response += f"  Profitto/Perdita: ${profit:.2f}\n"
-            response += f"  Percentuale: {profit_percentage:+.2f}%\n\n"
-        else:
-            response += f"{crypto}: Prezzo non disponibile\n\n"
-    
-    response += f"Profitto/Perdita totale: ${total_profit:.2f}"
-    bot.reply_to(message, response)
+    bot.reply_to(message, render_profit(rows))
 
 @bot.message_handler(commands=['weekly'])
 @authorized_only
 def show_weekly_comparison(message):
-    seven_days_ago = datetime.now().date() - timedelta(days=7)
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT crypto, 
-           SUM(CASE WHEN date <= ? THEN quantity ELSE 0 END) as quantity_7_days_ago,
-           SUM(quantity) as current_quantity
-    FROM transactions 
-    WHERE user_id = ?
-    GROUP BY crypto
-    """, (seven_days_ago, message.from_user.id))
-    results = cursor.fetchall()
-    conn.close()
-    
-    if not results:
+    rows = load_portfolio(message.from_user.id)
+    if not rows:
         bot.reply_to(message, "Non hai transazioni sufficienti per un confronto settimanale.")
         return
-    
-    response = "Confronto con 7 giorni fa:\n\n"
-    for result in results:
-        crypto = result['crypto']
-        quantity_7_days_ago = result['quantity_7_days_ago']
-        current_quantity = result['current_quantity']
-        current_price, _ = get_current_price(crypto)
-        if current_price is not None:
-            value_7_days_ago = quantity_7_days_ago * current_price
-            current_value = current_quantity * current_price
-            difference = current_value - value_7_days_ago
-            difference_percentage = (difference / value_7_days_ago) * 100 if value_7_days_ago != 0 else 0
-            
-            response += f"{crypto}:\n"
-            response += f"  7 giorni fa: {quantity_7_days_ago:.4f} (${value_7_days_ago:.2f})\n"
-            response += f"  Oggi: {current_quantity:.4f} (${current_value:.2f})\n"
-            response += f"  Differenza: ${difference:.2f} ({difference_percentage:+.2f}%)\n\n"
-        else:
-            response += f"{crypto}: Prezzo non disponibile\n\n"
-    
-    bot.reply_to(message, response)
+    bot.reply_to(message, render_weekly(rows))
 
 @bot.message_handler(commands=['history'])
 @authorized_only
@@ -384,7 +825,7 @@ def show_history(message):
         
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("SELECT quantity, price, date FROM transactions WHERE user_id = ? AND crypto = ? ORDER BY date", (message.from_user.id, crypto))
+        cursor.execute("SELECT quantity, price, date FROM all_transactions WHERE user_id = ? AND crypto = ? ORDER BY date", (message.from_user.id, crypto))
         transactions = cursor.fetchall()
         conn.close()
         
@@ -392,15 +833,8 @@ def show_history(message):
             bot.reply_to(message, f"Non hai transazioni per {crypto}.")
             return
         
-        response = f"Storico delle transazioni per {crypto}:\n\n"
-        for transaction in transactions:
-            response += f"Data: {transaction['date']}, Quantità: {transaction['quantity']:.4f}, Prezzo: ${transaction['price']:.2f}\n"
-        
         current_price, _ = get_current_price(crypto)
-        if current_price is not None:
-            response += f"\nPrezzo attuale di {crypto}: ${current_price:.2f}"
-        
-        bot.reply_to(message, response)
+        bot.reply_to(message, render_history(crypto, transactions, current_price))
     except ValueError:
         bot.reply_to(message, "Formato non valido. Usa: /history SIMBOLO (es. /history BTC)")
 
@@ -415,18 +849,62 @@ def confirm_reset(message):
         conn = get_db_connection()
         cursor = conn.cursor()
         cursor.execute("DELETE FROM transactions WHERE user_id = ?", (message.from_user.id,))
+        cursor.execute("DELETE FROM transactions_archive WHERE user_id = ?", (message.from_user.id,))
+        cursor.execute("DELETE FROM opening_balances WHERE user_id = ?", (message.from_user.id,))
         conn.commit()
         conn.close()
+        mark_transactions_changed(message.from_user.id)
         bot.reply_to(message, "Tutti i tuoi dati sono stati cancellati.")
     else:
         bot.reply_to(message, "Operazione annullata. I tuoi dati sono al sicuro.")
 
+def rebuild_opening_balance(cursor, user_id, crypto):
+    """Ricalcola il saldo di apertura di una posizione dalle sue transazioni archiviate."""
+    cursor.execute("DELETE FROM opening_balances WHERE user_id = ? AND crypto = ?", (user_id, crypto))
+    cursor.execute("""
+    INSERT INTO opening_balances (user_id, crypto, quantity, cost, first_purchase_date, last_archived_date)
+    SELECT user_id, crypto, SUM(quantity), SUM(quantity * price), MIN(date), MAX(date)
+    FROM transactions_archive WHERE user_id = ? AND crypto = ?
+    GROUP BY user_id, crypto
+    """, (user_id, crypto))
+
+def delete_transaction(user_id, transaction_id):
+    """Elimina una transazione, recente o archiviata; per quelle archiviate aggiorna il saldo di apertura."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM transactions WHERE id = ? AND user_id = ?", (transaction_id, user_id))
+    if not cursor.rowcount:
+        cursor.execute("SELECT crypto FROM transactions_archive WHERE id = ? AND user_id = ?", (transaction_id, user_id))
+        archived = cursor.fetchone()
+        if archived:
+            cursor.execute("DELETE FROM transactions_archive WHERE id = ?", (transaction_id,))
+            rebuild_opening_balance(cursor, user_id, archived['crypto'])
+    conn.commit()
+    conn.close()
+
+def update_transaction(user_id, transaction_id, crypto, quantity, price, date):
+    """Modifica una transazione; se era archiviata torna tra quelle recenti con lo stesso id."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("UPDATE transactions SET crypto = ?, quantity = ?, price = ?, date = ? WHERE id = ? AND user_id = ?",
+                   (crypto, quantity, price, date, transaction_id, user_id))
+    if not cursor.rowcount:
+        cursor.execute("SELECT crypto FROM transactions_archive WHERE id = ? AND user_id = ?", (transaction_id, user_id))
+        archived = cursor.fetchone()
+        if archived:
+            cursor.execute("DELETE FROM transactions_archive WHERE id = ?", (transaction_id,))
+            rebuild_opening_balance(cursor, user_id, archived['crypto'])
+            cursor.execute("INSERT INTO transactions (id, user_id, crypto, quantity, price, date) VALUES (?, ?, ?, ?, ?, ?)",
+                           (transaction_id, user_id, crypto, quantity, price, date))
+    conn.commit()
+    conn.close()
+
 @bot.message_handler(commands=['deleteedit'])
 @authorized_only
 def deleteedit_transaction_start(message):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, crypto, quantity, price, date FROM transactions WHERE user_id = ? ORDER BY date DESC LIMIT 10", (message.from_user.id,))
+    cursor.execute("SELECT id, crypto, quantity, price, date FROM all_transactions WHERE user_id = ? ORDER BY date DESC LIMIT 10", (message.from_user.id,))
     transactions = cursor.fetchall()
     conn.close()
     
@@ -457,11 +935,8 @@ def process_delete_selection(message, transactions):
 def process_delete_action(message, transaction):
     action = message.text.upper()
     if action == 'E':
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM transactions WHERE id = ?", (transaction['id'],))
-        conn.commit()
-        conn.close()
+        delete_transaction(message.from_user.id, transaction['id'])
+        mark_transactions_changed(message.from_user.id)
         bot.reply_to(message, "Transazione eliminata con successo.")
     elif action == 'M':
         msg = bot.reply_to(message, "Inserisci i nuovi dettagli della transazione nel formato: SIMBOLO PREZZO QUANTITÀ DATA (es. BTC 30000 0.1 25-12-2023)")
@@ -476,12 +951,8 @@ def process_modify_transaction(message, transaction_id):
         quantity = float(quantity)
         date = datetime.strptime(date, "%d-%m-%Y").date()
         
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("UPDATE transactions SET crypto = ?, quantity = ?, price = ?, date = ? WHERE id = ?",
-                       (crypto.upper(), quantity, price, date, transaction_id))
-        conn.commit()
-        conn.close()
+        update_transaction(message.from_user.id, transaction_id, crypto.upper(), quantity, price, date)
+        mark_transactions_changed(message.from_user.id)
         
         bot.reply_to(message, f"Transazione modificata con successo: {quantity:.4f} {crypto.upper()} a ${price:.2f} il {date.strftime('%d-%m-%Y')}")
     except ValueError:
@@ -494,7 +965,7 @@ def process_modify_transaction(message, transaction_id):
 def debug_transactions(message):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM transactions WHERE user_id = ? ORDER BY date DESC LIMIT 20", (message.from_user.id,))
+    cursor.execute("SELECT * FROM all_transactions WHERE user_id = ? ORDER BY date DESC LIMIT 20", (message.from_user.id,))
     transactions = cursor.fetchall()
     conn.close()
     
@@ -508,36 +979,81 @@ def debug_transactions(message):
     
     bot.reply_to(message, response)
 
+# Formati degli alert
+ALERT_FORMATS = """Formati disponibili:
+SIMBOLO PREZZO SOPRA/SOTTO - prezzo (es. BTC 30000 SOPRA)
+SIMBOLO PERCENTUALE% SOPRA/SOTTO - variazione dal prezzo attuale (es. BTC 5% SOTTO)
+SIMBOLO TRAILING PERCENTUALE% - trailing stop dal massimo (es. BTC TRAILING 10%)
+SIMBOLO VOLATILITA PERCENTUALE% - variazione 24h in valore assoluto (es. BTC VOLATILITA 8%)
+PORTAFOGLIO VALORE SOPRA/SOTTO - valore totale del portafoglio (es. PORTAFOGLIO 50000 SOPRA)"""
+
+def parse_alert(text):
+    """Restituisce (crypto, alert_type, target, is_above); solleva ValueError se il formato non è valido."""
+    first, second, third = text.upper().split()
+    if first == PORTFOLIO_SYMBOL:
+        return None, 'portfolio', float(second), third == 'SOPRA'
+    if second == 'TRAILING':
+        return first, 'trailing', abs(float(third.rstrip('%'))), False
+    if second in ('VOLATILITA', 'VOLATILITÀ'):
+        return first, 'volatility', abs(float(third.rstrip('%'))), True
+    if second.endswith('%'):
+        return first, 'percent', abs(float(second.rstrip('%'))), third == 'SOPRA'
+    return first, 'price', float(second), third == 'SOPRA'
+
+def describe_alert(crypto, alert_type, target, is_above):
+    direction = "sopra" if is_above else "sotto"
+    if alert_type == 'portfolio':
+        return f"Portafoglio {direction} ${target:.2f}"
+    if alert_type == 'percent':
+        return f"{crypto} {'+' if is_above else '-'}{target:.2f}% dal prezzo iniziale"
+    if alert_type == 'trailing':
+        return f"{crypto} trailing stop {target:.2f}% dal massimo"
+    if alert_type == 'volatility':
+        return f"{crypto} variazione 24h oltre ±{target:.2f}%"
+    return f"{crypto} {direction} ${target:.2f}"
+
+def initial_reference(crypto, alert_type):
+    """Prezzo di partenza di percentuale e trailing stop: l'ultimo noto quando l'alert viene creato."""
+    if alert_type not in ('percent', 'trailing'):
+        return None
+    price, _ = get_current_prices([crypto]).get(crypto, (None, None))
+    # Se CoinMarketCap non risponde si usa l'ultimo tick; senza prezzi parte dal primo tick successivo
+    return price if price is not None else alert_index.last_price(crypto)
+
+def describe_reference(reference):
+    return f" (prezzo di riferimento ${reference:.2f})" if reference is not None else ""
+
 @bot.message_handler(commands=['setalert'])
 @authorized_only
 def set_price_alert(message):
-    msg = bot.reply_to(message, "Inserisci l'avviso di prezzo nel formato: SIMBOLO PREZZO SOPRA/SOTTO (es. BTC 30000 SOPRA)")
+    msg = bot.reply_to(message, f"Inserisci l'avviso nel formato desiderato.\n{ALERT_FORMATS}")
     bot.register_next_step_handler(msg, process_price_alert)
 
 def process_price_alert(message):
     try:
-        crypto, price, direction = message.text.split()
-        price = float(price)
-        is_above = direction.upper() == 'SOPRA'
+        crypto, alert_type, target, is_above = parse_alert(message.text)
         
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("INSERT INTO price_alerts (user_id, crypto, target_price, is_above) VALUES (?, ?, ?, ?)",
-                       (message.from_user.id, crypto.upper(), price, is_above))
+        reference = initial_reference(crypto, alert_type)
+        cursor.execute("""INSERT INTO price_alerts (user_id, crypto, target_price, is_above, alert_type, reference_price)
+                       VALUES (?, ?, ?, ?, ?, ?)""",
+                       (message.from_user.id, crypto, target, is_above, alert_type, reference))
         conn.commit()
         conn.close()
         
-        direction_text = "sopra" if is_above else "sotto"
-        bot.reply_to(message, f"Avviso impostato per {crypto.upper()} quando il prezzo sarà {direction_text} ${price:.2f}")
+        reload_alert_index()
+
+        bot.reply_to(message, f"Avviso impostato: {describe_alert(crypto, alert_type, target, is_above)}{describe_reference(reference)}")
     except ValueError:
-        bot.reply_to(message, "Formato non valido. Usa: SIMBOLO PREZZO SOPRA/SOTTO (es. BTC 30000 SOPRA)")
+        bot.reply_to(message, f"Formato non valido.\n{ALERT_FORMATS}")
 
 @bot.message_handler(commands=['viewalerts'])
 @authorized_only
 def view_alerts(message):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, crypto, target_price, is_above FROM price_alerts WHERE user_id = ?", (message.from_user.id,))
+    cursor.execute("SELECT id, crypto, target_price, is_above, alert_type FROM price_alerts WHERE user_id = ?", (message.from_user.id,))
     alerts = cursor.fetchall()
     conn.close()
     
@@ -547,8 +1063,8 @@ def view_alerts(message):
     
     response = "I tuoi alert di prezzo:\n\n"
     for alert in alerts:
-        direction = "sopra" if alert['is_above'] else "sotto"
-        response += f"ID: {alert['id']} - {alert['crypto']} {direction} ${alert['target_price']:.2f}\n"
+        description = describe_alert(alert['crypto'], alert['alert_type'] or 'price', alert['target_price'], alert['is_above'])
+        response += f"ID: {alert['id']} - {description}\n"
     
     bot.reply_to(message, response)
 
@@ -569,30 +1085,33 @@ def process_edit_alert_id(message):
         conn.close()
         
         if alert:
-            msg = bot.reply_to(message, f"Stai modificando l'alert per {alert['crypto']}. Inserisci i nuovi dettagli nel formato: PREZZO SOPRA/SOTTO")
-            bot.register_next_step_handler(msg, process_edit_alert, alert_id)
+            symbol = alert['crypto'] or PORTFOLIO_SYMBOL
+            msg = bot.reply_to(message, f"Stai modificando l'alert per {symbol}. Inserisci i nuovi dettagli senza il simbolo "
+                                        f"(es. 30000 SOPRA, 5% SOTTO, TRAILING 10%, VOLATILITA 8%)")
+            bot.register_next_step_handler(msg, process_edit_alert, alert_id, symbol)
         else:
             bot.reply_to(message, "Alert non trovato. Usa /viewalerts per vedere i tuoi alert.")
     except ValueError:
         bot.reply_to(message, "Per favore, inserisci un ID valido.")
 
-def process_edit_alert(message, alert_id):
+def process_edit_alert(message, alert_id, symbol):
     try:
-        price, direction = message.text.split()
-        price = float(price)
-        is_above = direction.upper() == 'SOPRA'
+        crypto, alert_type, target, is_above = parse_alert(f"{symbol} {message.text}")
         
         conn = get_db_connection()
         cursor = conn.cursor()
-        cursor.execute("UPDATE price_alerts SET target_price = ?, is_above = ? WHERE id = ? AND user_id = ?",
-                       (price, is_above, alert_id, message.from_user.id))
+        reference = initial_reference(crypto, alert_type)
+        cursor.execute("""UPDATE price_alerts SET target_price = ?, is_above = ?, alert_type = ?, reference_price = ?
+                       WHERE id = ? AND user_id = ?""",
+                       (target, is_above, alert_type, reference, alert_id, message.from_user.id))
         conn.commit()
         conn.close()
         
-        direction_text = "sopra" if is_above else "sotto"
-        bot.reply_to(message, f"Alert modificato: nuovo target {direction_text} ${price:.2f}")
+        reload_alert_index(references=[(reference, alert_id)])
+
+        bot.reply_to(message, f"Alert modificato: {describe_alert(crypto, alert_type, target, is_above)}{describe_reference(reference)}")
     except ValueError:
-        bot.reply_to(message, "Formato non valido. Usa: PREZZO SOPRA/SOTTO")
+        bot.reply_to(message, "Formato non valido. Usa: PREZZO SOPRA/SOTTO, PERCENTUALE% SOPRA/SOTTO, TRAILING PERCENTUALE% o VOLATILITA PERCENTUALE%")
 
 @bot.message_handler(commands=['deletealert'])
 @authorized_only
@@ -612,6 +1131,7 @@ def process_delete_alert(message):
         conn.close()
         
         if deleted:
+            reload_alert_index()
             bot.reply_to(message, f"Alert con ID {alert_id} eliminato con successo.")
         else:
             bot.reply_to(message, "Alert non trovato. Usa /viewalerts per vedere i tuoi alert.")
@@ -679,6 +1199,64 @@ def show_report(message):
     else:
         bot.reply_to(message, "Non hai report programmati al momento.")
 
+@bot.message_handler(commands=['live'])
+@authorized_only
+def start_live(message):
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1].lower() == 'stop':
+        if stop_live_message(message.chat.id):
+            bot.reply_to(message, "Aggiornamento live disattivato.")
+        else:
+            bot.reply_to(message, "Non hai un messaggio live attivo.")
+        return
+
+    rows = load_portfolio(message.from_user.id)
+    if not rows:
+        bot.reply_to(message, "📊 Non hai ancora aggiunto alcuna transazione.")
+        return
+
+    # Un solo messaggio live per chat: quello precedente viene sganciato
+    stop_live_message(message.chat.id)
+    text = render_live(rows)
+    msg = bot.send_message(message.chat.id, text, parse_mode='Markdown')
+    try:
+        bot.pin_chat_message(message.chat.id, msg.message_id, disable_notification=True)
+    except ApiTelegramException:
+        pass
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO live_messages (chat_id, user_id, message_id, content_hash) VALUES (?, ?, ?, ?)",
+                   (message.chat.id, message.from_user.id, msg.message_id, content_hash(text)))
+    conn.commit()
+    conn.close()
+
+@bot.message_handler(commands=['chart'])
+@authorized_only
+def show_allocation_chart(message):
+    future = get_allocation_chart(message.from_user.id, load_portfolio(message.from_user.id))
+    if future is None:
+        bot.reply_to(message, "Non hai ancora aggiunto alcuna transazione.")
+        return
+    deliver_chart_later(message.chat.id, future, "📊 Allocazione del portafoglio")
+
+@bot.message_handler(commands=['chartvalue'])
+@authorized_only
+def show_value_chart(message):
+    parts = message.text.split()
+    period = parts[1].lower() if len(parts) > 1 else '30d'
+    if period not in CHART_PERIODS:
+        bot.reply_to(message, "Formato non valido. Usa: /chartvalue PERIODO (7d, 30d, 90d, 1y)")
+        return
+
+    history = get_value_history(message.from_user.id, CHART_PERIODS[period])
+    if history is None:
+        bot.reply_to(message, "Non hai ancora aggiunto alcuna transazione.")
+        return
+    priced, series = history
+    future = get_chart(message.from_user.id, period, priced, charts.render_value_chart, *series)
+    deliver_chart_later(message.chat.id, future, f"📈 Valore del portafoglio ({period})")
+
 @bot.message_handler(commands=['exportexcel'])
 @authorized_only
 def export_excel(message):
@@ -702,54 +1280,29 @@ def process_excel_import(message):
     try:
         excel_file = BytesIO(downloaded_file)
         num_imported = import_transactions_from_excel(message.from_user.id, excel_file)
+        mark_transactions_changed(message.from_user.id)
         bot.reply_to(message, f"Importazione completata con successo. {num_imported} transazioni importate.")
     except Exception as e:
         bot.reply_to(message, f"Si è verificato un errore durante l'importazione: {str(e)}")
 
 def send_scheduled_report(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-    SELECT crypto, SUM(quantity) as total_quantity
-    FROM transactions 
-    WHERE user_id = ?
-    GROUP BY crypto
-    """, (user_id,))
-    results = cursor.fetchall()
-    conn.close()
-    
-    if not results:
+    rows = load_portfolio(user_id)
+    if not rows:
         bot.send_message(user_id, "Non hai transazioni nel tuo portafoglio.")
         return
     
-    response = "📊 *Resoconto del tuo Portafoglio*\n\n"
-    total_portfolio_value = 0
-    total_portfolio_value_24h_ago = 0
-    
-    for result in results:
-        crypto = result['crypto']
-        quantity = result['total_quantity']
-        current_price, percent_change_24h = get_current_price(crypto)
-        
-        if current_price is not None:
-            value = quantity * current_price
-            value_24h_ago = value / (1 + percent_change_24h/100)
-            change_value = value - value_24h_ago
-            total_portfolio_value += value
-            total_portfolio_value_24h_ago += value_24h_ago
-            
-            response += f"*{crypto}*: ${value:.2f} (${change_value:.2f}, {percent_change_24h:.2f}%)\n"
-    
-    change_24h = total_portfolio_value - total_portfolio_value_24h_ago
-    change_24h_percent = (change_24h / total_portfolio_value_24h_ago) * 100
-    
-    response += f"\n*Totale: ${total_portfolio_value:.2f}*\n"
-    response += f"Variazione 24h: ${change_24h:.2f} ({change_24h_percent:.2f}%)"
-    
-    bot.send_message(user_id, response, parse_mode='Markdown')
+    bot.send_message(user_id, render_report(rows), parse_mode='Markdown')
+
+    # Il grafico è condiviso con /chart finché i dati non cambiano
+    chart = get_allocation_chart(user_id, rows)
+    if chart is not None:
+        deliver_chart(user_id, chart, "📊 Allocazione del portafoglio")
 
 def update_report_scheduler():
-    scheduler.remove_all_jobs()
+    # Solo i job dei report: quelli di manutenzione restano programmati
+    for job in scheduler.get_jobs():
+        if job.func is send_scheduled_report:
+            job.remove()
     
     conn = get_db_connection()
     cursor = conn.cursor()
@@ -780,31 +1333,482 @@ def update_report_scheduler():
             scheduler.add_job(send_scheduled_report, 'cron', month='1,7', day=1, hour=time.hour, minute=time.minute, args=[user_id])
         elif frequency == 'annually':
             scheduler.add_job(send_scheduled_report, 'cron', month=1, day=1, hour=time.hour, minute=time.minute, args=[user_id])
-def check_price_alerts():
+# Compattazione e archiviazione delle transazioni
+# Le posizioni chiuse vengono archiviate solo fuori dalla finestra di /weekly
+COMPACTION_CLOSED_AFTER_DAYS = 7
+# Nemmeno le altre transazioni possono entrare nei saldi di apertura finché servono a /weekly
+COMPACTION_KEEP_DAYS = max(int(os.getenv('COMPACTION_KEEP_DAYS', '365')), COMPACTION_CLOSED_AFTER_DAYS)
+
+def compact_transactions():
+    """Sposta in archivio le transazioni vecchie o di posizioni chiuse, accumulandole nei saldi di apertura."""
+    today = datetime.now().date()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TEMP TABLE compaction AS
+    SELECT id, user_id, crypto, quantity, price, date FROM transactions
+    WHERE date < ?
+       OR (user_id, crypto) IN (
+           SELECT user_id, crypto FROM holdings_ledger
+           GROUP BY user_id, crypto
+           HAVING ABS(SUM(quantity)) < 1e-9 AND MAX(last_date) <= ?)
+    """, (today - timedelta(days=COMPACTION_KEEP_DAYS), today - timedelta(days=COMPACTION_CLOSED_AFTER_DAYS)))
+    cursor.execute("""
+    INSERT INTO transactions_archive (id, user_id, crypto, quantity, price, date)
+    SELECT id, user_id, crypto, quantity, price, date FROM compaction
+    """)
+    archived = cursor.rowcount
+    cursor.execute("""
+    INSERT INTO opening_balances (user_id, crypto, quantity, cost, first_purchase_date, last_archived_date)
+    SELECT user_id, crypto, SUM(quantity), SUM(quantity * price), MIN(date), MAX(date)
+    FROM compaction WHERE true
+    GROUP BY user_id, crypto
+    ON CONFLICT (user_id, crypto) DO UPDATE SET
+        quantity = quantity + excluded.quantity,
+        cost = cost + excluded.cost,
+        first_purchase_date = MIN(first_purchase_date, excluded.first_purchase_date),
+        last_archived_date = MAX(last_archived_date, excluded.last_archived_date)
+    """)
+    cursor.execute("DELETE FROM transactions WHERE id IN (SELECT id FROM compaction)")
+    cursor.execute("DROP TABLE compaction")
+    conn.commit()
+
+    if archived:
+        cursor.execute("ANALYZE")
+    conn.close()
+    print(f"Compattazione completata: {archived} transazioni archiviate")
+    return archived
+
+def vacuum_database():
+    conn = get_db_connection()
+    conn.execute("VACUUM")
+    conn.close()
+
+# Valutazione degli alert guidata dai tick di prezzo
+ALERT_TYPES = ('price', 'percent', 'trailing', 'volatility', 'portfolio')
+KIND_PRICE, KIND_PERCENT, KIND_TRAILING, KIND_VOLATILITY, KIND_PORTFOLIO = range(len(ALERT_TYPES))
+PORTFOLIO_SYMBOL = 'PORTAFOGLIO'
+
+# Alert scattato: `value` è il prezzo, la variazione %, il massimo o il valore del portafoglio a seconda del tipo
+FiredAlert = namedtuple('FiredAlert', 'alert_id user_id alert_type crypto target is_above value price')
+
+class SymbolAlerts:
+    """Alert attivi di un simbolo come array paralleli, valutati in un solo passaggio vettoriale."""
+
+    def __init__(self, crypto, alerts):
+        self.crypto = crypto
+        self.ids = np.array([alert['id'] for alert in alerts], dtype=np.int64)
+        self.user_ids = np.array([alert['user_id'] for alert in alerts], dtype=np.int64)
+        self.kinds = np.array([ALERT_TYPES.index(alert['alert_type'] or 'price') for alert in alerts], dtype=np.int8)
+        self.targets = np.array([alert['target_price'] for alert in alerts], dtype=np.float64)
+        self.above = np.array([bool(alert['is_above']) for alert in alerts], dtype=bool)
+        self.reference = np.array([np.nan if alert['reference_price'] is None else alert['reference_price']
+                                   for alert in alerts], dtype=np.float64)
+        self.active = np.ones(len(alerts), dtype=bool)
+        self.dirty = np.zeros(len(alerts), dtype=bool)
+
+    def evaluate(self, price, change_24h):
+        """Disattiva e restituisce gli alert scattati con il tick."""
+        kinds, targets, above, reference = self.kinds, self.targets, self.above, self.reference
+
+        # Percentuale e trailing stop partono dal primo prezzo osservato; il trailing segue il massimo
+        relative = self.active & ((kinds == KIND_PERCENT) | (kinds == KIND_TRAILING))
+        unset = relative & np.isnan(reference)
+        reference[unset] = price
+        raised = relative & (kinds == KIND_TRAILING) & (price > reference)
+        reference[raised] = price
+
+        # Il confronto è sempre con il nuovo prezzo: un alert già superato quando viene caricato
+        # scatta al primo tick oltre la soglia, mai su un movimento nella direzione opposta
+        change = (price / reference - 1) * 100
+        fired = (
+            ((kinds == KIND_PRICE) & np.where(above, targets < price, targets > price))
+            | ((kinds == KIND_PERCENT) & np.where(above, change >= targets, change <= -targets))
+            | ((kinds == KIND_TRAILING) & (price <= reference * (1 - targets / 100)))
+        )
+        if change_24h is not None:
+            fired |= (kinds == KIND_VOLATILITY) & (abs(change_24h) >= targets)
+        fired &= self.active
+        self.active &= ~fired
+        self.dirty |= (unset | raised) & self.active
+
+        fired = np.flatnonzero(fired)
+        values = np.select(
+            [kinds[fired] == KIND_PERCENT, kinds[fired] == KIND_TRAILING, kinds[fired] == KIND_VOLATILITY],
+            [(price / reference[fired] - 1) * 100, reference[fired], np.nan if change_24h is None else change_24h],
+            price)
+        return [FiredAlert(alert_id, user_id, ALERT_TYPES[kind], self.crypto, target, is_above, value, price)
+                for alert_id, user_id, kind, target, is_above, value in zip(
+                    self.ids[fired].tolist(), self.user_ids[fired].tolist(), kinds[fired].tolist(),
+                    targets[fired].tolist(), above[fired].tolist(), values.tolist())]
+
+    def reset_references(self, alert_ids):
+        # Alert modificati: il riferimento in memoria non deve sovrascrivere quello azzerato nel database
+        reset = np.isin(self.ids, alert_ids)
+        self.dirty[reset] = False
+        self.reference[reset] = np.nan
+
+    def rearm(self, alert_ids):
+        self.active[np.isin(self.ids, alert_ids)] = True
+
+    def pop_references(self):
+        """Riferimenti (massimi del trailing, prezzi iniziali) modificati dall'ultimo salvataggio."""
+        dirty = np.flatnonzero(self.dirty & self.active)
+        self.dirty[:] = False
+        return list(zip(self.reference[dirty].tolist(), self.ids[dirty].tolist()))
+
+    def has_active(self):
+        return bool(self.active.any())
+
+class PortfolioAlerts:
+    """Alert sul valore totale del portafoglio: matrice utenti x simboli delle quantità detenute."""
+
+    def __init__(self, alerts, holdings):
+        users = sorted({alert['user_id'] for alert in alerts})
+        self.user_rows = user_rows = {user_id: row for row, user_id in enumerate(users)}
+        self.symbols = sorted({holding['crypto'] for holding in holdings if holding['user_id'] in user_rows})
+        self.columns = {crypto: column for column, crypto in enumerate(self.symbols)}
+        self.quantities = np.zeros((len(users), len(self.symbols)), dtype=np.float64)
+        for holding in holdings:
+            if holding['user_id'] in user_rows:
+                self.quantities[user_rows[holding['user_id']], self.columns[holding['crypto']]] = holding['total_quantity']
+        self.prices = np.full(len(self.symbols), np.nan)
+
+        self.ids = np.array([alert['id'] for alert in alerts], dtype=np.int64)
+        self.user_ids = np.array([alert['user_id'] for alert in alerts], dtype=np.int64)
+        self.rows = np.array([user_rows[alert['user_id']] for alert in alerts], dtype=np.int64)
+        self.targets = np.array([alert['target_price'] for alert in alerts], dtype=np.float64)
+        self.above = np.array([bool(alert['is_above']) for alert in alerts], dtype=bool)
+        self.active = np.ones(len(alerts), dtype=bool)
+
+    def evaluate(self, quotes):
+        """Valuta gli alert degli utenti che detengono almeno uno dei simboli aggiornati.
+
+        Il valore di ogni utente viene calcolato una sola volta per batch di prezzi; i simboli senza
+        prezzo (per esempio quelli scartati da CoinMarketCap) vengono ignorati.
+        """
+        updated = [self.columns[crypto] for crypto in quotes if crypto in self.columns]
+        if not updated:
+            return []
+        for crypto, (price, _) in quotes.items():
+            if crypto in self.columns:
+                self.prices[self.columns[crypto]] = price
+
+        holders = (self.quantities[:, updated] != 0).any(axis=1)
+        candidates = self.active & holders[self.rows]
+        if not candidates.any():
+            return []
+
+        priced = ~np.isnan(self.prices)
+        values = (self.quantities[:, priced] @ self.prices[priced])[self.rows]
+        fired = candidates & np.where(self.above, values > self.targets, values < self.targets)
+        self.active &= ~fired
+        fired = np.flatnonzero(fired)
+        return [FiredAlert(alert_id, user_id, 'portfolio', None, target, is_above, value, None)
+                for alert_id, user_id, target, is_above, value in zip(
+                    self.ids[fired].tolist(), self.user_ids[fired].tolist(), self.targets[fired].tolist(),
+                    self.above[fired].tolist(), values[fired].tolist())]
+
+    def rearm(self, alert_ids):
+        self.active[np.isin(self.ids, alert_ids)] = True
+
+    def update_holdings(self, user_id, holdings):
+        """Sostituisce le quantità di un utente, aggiungendo le colonne dei simboli nuovi."""
+        row = self.user_rows.get(user_id)
+        if row is None:
+            return
+        new_symbols = sorted({holding['crypto'] for holding in holdings} - self.columns.keys())
+        if new_symbols:
+            self.columns.update((crypto, len(self.symbols) + offset) for offset, crypto in enumerate(new_symbols))
+            self.symbols.extend(new_symbols)
+            self.quantities = np.hstack([self.quantities, np.zeros((len(self.quantities), len(new_symbols)))])
+            self.prices = np.append(self.prices, np.full(len(new_symbols), np.nan))
+        self.quantities[row] = 0
+        for holding in holdings:
+            self.quantities[row, self.columns[holding['crypto']]] = holding['total_quantity']
+
+    def active_symbols(self):
+        if not self.active.any():
+            return set()
+        held = (self.quantities[np.unique(self.rows[self.active])] != 0).any(axis=0)
+        return {self.symbols[column] for column in np.flatnonzero(held)}
+
+class AlertIndex:
+    """Alert attivi raggruppati per simbolo, più gli alert sul valore del portafoglio."""
+
+    def __init__(self):
+        # Il portafoglio viene creato al primo caricamento, così numpy non serve all'import
+        self._lock = threading.Lock()
+        self._books = {}
+        self._portfolio = None
+        self._last_price = {}
+
+    def load(self, alerts, holdings):
+        grouped, portfolio = {}, []
+        for alert in alerts:
+            if alert['alert_type'] == 'portfolio':
+                portfolio.append(alert)
+            else:
+                grouped.setdefault(alert['crypto'], []).append(alert)
+        books = {crypto: SymbolAlerts(crypto, rows) for crypto, rows in grouped.items()}
+        portfolio_alerts = PortfolioAlerts(portfolio, holdings)
+        with self._lock:
+            self._fill_portfolio_prices(portfolio_alerts)
+            self._books, self._portfolio = books, portfolio_alerts
+
+    def _fill_portfolio_prices(self, portfolio):
+        for crypto, price in self._last_price.items():
+            if crypto in portfolio.columns:
+                portfolio.prices[portfolio.columns[crypto]] = price
+
+    def has_portfolio_alerts(self, user_id):
+        with self._lock:
+            return self._portfolio is not None and user_id in self._portfolio.user_rows
+
+    def update_holdings(self, user_id, holdings):
+        # Solo la riga dell'utente nella matrice del portafoglio: gli alert per simbolo non cambiano
+        with self._lock:
+            if self._portfolio is not None:
+                self._portfolio.update_holdings(user_id, holdings)
+                self._fill_portfolio_prices(self._portfolio)
+
+    def symbols(self):
+        with self._lock:
+            symbols = {crypto for crypto, book in self._books.items() if book.has_active()}
+            if self._portfolio is not None:
+                symbols |= self._portfolio.active_symbols()
+            return symbols
+
+    def last_price(self, crypto):
+        with self._lock:
+            return self._last_price.get(crypto)
+
+    def process_ticks(self, quotes):
+        """Restituisce gli alert scattati con un batch di prezzi {crypto: (prezzo, variazione 24h)}."""
+        with self._lock:
+            fired = []
+            for crypto, (price, change_24h) in quotes.items():
+                self._last_price[crypto] = price
+                book = self._books.get(crypto)
+                if book is not None:
+                    fired.extend(book.evaluate(price, change_24h))
+            if self._portfolio is not None:
+                fired.extend(self._portfolio.evaluate(quotes))
+            return fired
+
+    def reset_references(self, alert_ids):
+        with self._lock:
+            for book in self._books.values():
+                book.reset_references(alert_ids)
+
+    def rearm(self, alerts):
+        """Riattiva gli alert scattati ma non consegnati."""
+        with self._lock:
+            for alert in alerts:
+                if alert.alert_type == 'portfolio':
+                    self._portfolio.rearm([alert.alert_id])
+                else:
+                    self._books[alert.crypto].rearm([alert.alert_id])
+
+    def pop_references(self):
+        with self._lock:
+            return [reference for book in self._books.values() for reference in book.pop_references()]
+
+alert_index = AlertIndex()
+price_ticks = queue.Queue()
+RELOAD_ALERTS = object()
+RELOAD_HOLDINGS = object()
+
+def publish_price_ticks(quotes):
+    """Punto di ingresso comune per tutte le sorgenti di prezzo: {crypto: (prezzo, variazione 24h)}."""
+    if quotes:
+        price_ticks.put((quotes, monotonic()))
+
+def reload_alert_index(references=()):
+    # Il ricaricamento passa dalla stessa coda dei tick, così è serializzato con la valutazione
+    # e con il salvataggio dei riferimenti; `references` sono le coppie (riferimento, id) degli alert modificati
+    price_ticks.put((RELOAD_ALERTS, tuple(references)))
+
+def reload_portfolio_holdings(user_id):
+    # Le transazioni influenzano solo gli alert sul portafoglio, e solo per chi ne ha
+    if alert_index.has_portfolio_alerts(user_id):
+        price_ticks.put((RELOAD_HOLDINGS, user_id))
+
+def load_portfolio_holdings(user_id):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT * FROM price_alerts")
+    cursor.execute("SELECT crypto, SUM(quantity) as total_quantity FROM holdings_ledger WHERE user_id = ? GROUP BY crypto",
+                   (user_id,))
+    holdings = cursor.fetchall()
+    conn.close()
+    alert_index.update_holdings(user_id, holdings)
+
+def load_alert_index():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT id, user_id, crypto, target_price, is_above, alert_type, reference_price FROM price_alerts")
     alerts = cursor.fetchall()
+    cursor.execute("""
+    SELECT user_id, crypto, SUM(quantity) as total_quantity
+    FROM holdings_ledger
+    WHERE user_id IN (SELECT user_id FROM price_alerts WHERE alert_type = 'portfolio')
+    GROUP BY user_id, crypto
+    """)
+    holdings = cursor.fetchall()
     conn.close()
-    
-    for alert in alerts:
-        current_price, _ = get_current_price(alert['crypto'])
-        if current_price is not None:
-            if (alert['is_above'] and current_price > alert['target_price']) or \
-               (not alert['is_above'] and current_price < alert['target_price']):
-                user_id = alert['user_id']
-                crypto = alert['crypto']
-                target_price = alert['target_price']
-                direction = "sopra" if alert['is_above'] else "sotto"
-                message = f"⚠️ Avviso: il prezzo di {crypto} è ora ${current_price:.2f}, che è {direction} il tuo obiettivo di ${target_price:.2f}"
-                bot.send_message(user_id, message)
-                
-                # Rimuovi l'avviso dopo l'invio
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute("DELETE FROM price_alerts WHERE id = ?", (alert['id'],))
-                conn.commit()
-                conn.close()
+    alert_index.load(alerts, holdings)
+
+def save_alert_references():
+    references = alert_index.pop_references()
+    if not references:
+        return
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE price_alerts SET reference_price = ? WHERE id = ?", references)
+    conn.commit()
+    conn.close()
+
+def apply_alert_reload(references):
+    alert_index.reset_references([alert_id for _, alert_id in references])
+    # I massimi del trailing stop vivono in memoria: salvali prima di rileggere il database
+    save_alert_references()
+    if references:
+        # Un salvataggio periodico arrivato dopo la modifica potrebbe aver riscritto il vecchio riferimento
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.executemany("UPDATE price_alerts SET reference_price = ? WHERE id = ?", references)
+        conn.commit()
+        conn.close()
+    load_alert_index()
+
+def format_fired_alert(alert):
+    direction = "sopra" if alert.is_above else "sotto"
+    if alert.alert_type == 'percent':
+        return (f"⚠️ Avviso: il prezzo di {alert.crypto} è ora ${alert.price:.2f}, "
+                f"con una variazione del {alert.value:+.2f}% che supera la tua soglia del {alert.target:.2f}%")
+    if alert.alert_type == 'trailing':
+        return (f"⚠️ Trailing stop: il prezzo di {alert.crypto} è sceso a ${alert.price:.2f}, "
+                f"oltre il {alert.target:.2f}% sotto il massimo di ${alert.value:.2f}")
+    if alert.alert_type == 'volatility':
+        return (f"⚠️ Volatilità: la variazione 24h di {alert.crypto} è {alert.value:+.2f}%, "
+                f"oltre la tua soglia del {alert.target:.2f}%")
+    if alert.alert_type == 'portfolio':
+        return f"⚠️ Avviso: il valore del tuo portafoglio è ora ${alert.value:.2f}, che è {direction} il tuo obiettivo di ${alert.target:.2f}"
+    return f"⚠️ Avviso: il prezzo di {alert.crypto} è ora ${alert.price:.2f}, che è {direction} il tuo obiettivo di ${alert.target:.2f}"
+
+# Pausa tra due avvisi, come per i messaggi live
+ALERT_SEND_INTERVAL = 1 / 25
+# Istante prima del quale non inviare avvisi all'utente, dopo un errore 429 di Telegram
+alert_retry_at = {}
+
+def notify_price_alert(alert):
+    """Invia l'avviso e lo elimina dal database; False se l'invio va ritentato."""
+    if monotonic() < alert_retry_at.get(alert.user_id, 0):
+        return False
+    try:
+        bot.send_message(alert.user_id, format_fired_alert(alert))
+    except ApiTelegramException as e:
+        if e.error_code == 429:
+            alert_retry_at[alert.user_id] = monotonic() + e.result_json.get('parameters', {}).get('retry_after', 1)
+            return False
+        if e.error_code not in (400, 403):
+            print(f"Errore nell'invio dell'alert {alert.alert_id}: {e.description}")
+            return False
+        # Utente che ha bloccato il bot o chat inesistente: l'avviso non potrà mai essere consegnato
+        print(f"Alert {alert.alert_id} eliminato, utente {alert.user_id} non raggiungibile: {e.description}")
+    except requests.exceptions.RequestException as e:
+        print(f"Errore nell'invio dell'alert {alert.alert_id}: {e}")
+        return False
+
+    alert_retry_at.pop(alert.user_id, None)
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM price_alerts WHERE id = ?", (alert.alert_id,))
+    conn.commit()
+    conn.close()
+    # Resta sotto il limite globale di circa 30 messaggi al secondo
+    sleep(ALERT_SEND_INTERVAL)
+    return True
+
+def notify_fired_alerts(fired):
+    unsent = []
+    for alert in fired:
+        try:
+            if not notify_price_alert(alert):
+                unsent.append(alert)
+        except Exception as e:
+            print(f"Errore nella notifica dell'alert {alert.alert_id}: {e}")
+    # Gli avvisi non consegnati tornano attivi e scattano di nuovo al prossimo tick oltre la soglia
+    alert_index.rearm(unsent)
+
+def run_alert_evaluator():
+    load_alert_index()
+    last_saved = monotonic()
+    while True:
+        tick = price_ticks.get()
+        try:
+            if tick[0] is RELOAD_ALERTS:
+                apply_alert_reload(tick[1])
+                continue
+            if tick[0] is RELOAD_HOLDINGS:
+                load_portfolio_holdings(tick[1])
+                continue
+
+            quotes, received_at = tick
+            fired = alert_index.process_ticks(quotes)
+            if monotonic() - last_saved > ALERT_REFERENCE_SAVE_SECONDS:
+                save_alert_references()
+                last_saved = monotonic()
+            notify_fired_alerts(fired)
+
+            latency = monotonic() - received_at
+            if latency > ALERT_MAX_LATENCY:
+                print(f"Alert per {len(quotes)} simboli valutati con {latency:.2f}s di ritardo")
+        except Exception as e:
+            print(f"Errore nella valutazione degli alert: {e}")
+
+def run_price_refresh():
+    """Aggiornamento condiviso dei prezzi: una richiesta per i tick degli alert (feed 'poll') e per i messaggi live."""
+    while True:
+        try:
+            symbols = get_live_symbols()
+            if 'poll' in ALERT_FEEDS:
+                symbols |= alert_index.symbols()
+            prices = get_current_prices(symbols)
+            if 'poll' in ALERT_FEEDS:
+                publish_price_ticks(prices)
+            refresh_live_messages(prices)
+        except Exception as e:
+            print(f"Errore nell'aggiornamento dei prezzi: {e}")
+        sleep(ALERT_POLL_SECONDS)
+
+def run_simulated_price_feed():
+    """Sorgente di tick locale: random walk a partire dall'ultimo prezzo noto."""
+    prices, opening = {}, {}
+    while True:
+        quotes = {}
+        for crypto in alert_index.symbols():
+            if crypto not in prices:
+                prices[crypto] = opening[crypto] = alert_index.last_price(crypto) or get_current_price(crypto)[0] or 100.0
+            prices[crypto] *= 1 + random.gauss(0, 0.002)
+            quotes[crypto] = (prices[crypto], (prices[crypto] / opening[crypto] - 1) * 100)
+        publish_price_ticks(quotes)
+        sleep(ALERT_SIMULATED_SECONDS)
+
+def check_alert_feed():
+    unknown = ALERT_FEEDS - set(ALERT_FEED_NAMES)
+    if unknown:
+        raise ValueError(f"ALERT_FEED non valido: {', '.join(sorted(unknown))} (valori ammessi: {', '.join(ALERT_FEED_NAMES)})")
+    # Il feed simulato serve solo per i test: non deve mai mescolare prezzi finti con quelli reali
+    if {'poll', 'simulated'} <= ALERT_FEEDS:
+        raise ValueError("ALERT_FEED: 'poll' e 'simulated' non possono essere usati insieme")
+
+def start_alert_engine():
+    threading.Thread(target=run_alert_evaluator, name='alert-evaluator', daemon=True).start()
+    threading.Thread(target=run_price_refresh, name='price-refresh', daemon=True).start()
+    if 'simulated' in ALERT_FEEDS:
+        print("ATTENZIONE: feed dei prezzi simulato attivo, gli alert scatteranno su prezzi finti e verranno eliminati")
+        threading.Thread(target=run_simulated_price_feed, name='price-feed-simulated', daemon=True).start()
 
 # Gestione dei messaggi non riconosciuti
 @bot.message_handler(func=lambda message: True)
@@ -812,10 +1816,31 @@ def check_price_alerts():
 def echo_all(message):
     bot.reply_to(message, "Comando non riconosciuto. Usa /help per vedere l'elenco dei comandi disponibili.")
 
-if __name__ == "__main__":
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(check_price_alerts, 'interval', minutes=5)
-    update_report_scheduler()
-    scheduler.start()
-    
+def print_startup_report():
+    print("Tempi di avvio:")
+    for label, elapsed in startup_timings:
+        print(f"  {label:<16} {elapsed * 1000:8.1f} ms")
+    print(f"  {'totale':<16} {(perf_counter() - STARTED_AT) * 1000:8.1f} ms")
+
+def main():
+    global scheduler
+    check_alert_feed()
+    with startup_phase('locale'):
+        locale.setlocale(locale.LC_ALL, '')
+    with startup_phase('database'):
+        init_db()
+    with startup_phase('scheduler'):
+        from apscheduler.schedulers.background import BackgroundScheduler
+        scheduler = BackgroundScheduler()
+        scheduler.add_job(compact_transactions, 'cron', hour=3, minute=30)
+        scheduler.add_job(vacuum_database, 'cron', day_of_week='sun', hour=4)
+        update_report_scheduler()
+        scheduler.start()
+    with startup_phase('alert engine'):
+        start_alert_engine()
+    print_startup_report()
+
     bot.infinity_polling()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,439 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import date
+
+import pytest
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:TEST')
+os.environ.setdefault('AUTHORIZED_USER_ID', '1')
+
+import crypto2
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    crypto2.init_db()
+    conn = crypto2.get_db_connection()
+    yield conn
+    conn.close()
+
+
+def make_alert(alert_id, crypto, target, is_above, alert_type='price', reference=None, user_id=1):
+    return {'id': alert_id, 'user_id': user_id, 'crypto': crypto, 'target_price': target, 'is_above': is_above,
+            'alert_type': alert_type, 'reference_price': reference}
+
+
+def fired_ids(fired):
+    return [alert.alert_id for alert in fired]
+
+
+# Alert
+def test_parse_alert_formats():
+    assert crypto2.parse_alert("btc 30000 sopra") == ('BTC', 'price', 30000.0, True)
+    assert crypto2.parse_alert("BTC 5% SOTTO") == ('BTC', 'percent', 5.0, False)
+    assert crypto2.parse_alert("BTC TRAILING 10%") == ('BTC', 'trailing', 10.0, False)
+    assert crypto2.parse_alert("BTC VOLATILITA 8%") == ('BTC', 'volatility', 8.0, True)
+    assert crypto2.parse_alert("PORTAFOGLIO 50000 SOPRA") == (None, 'portfolio', 50000.0, True)
+
+
+@pytest.mark.parametrize('text', ["BTC 30000", "BTC abc SOPRA", "PORTAFOGLIO TRAILING 10%", "BTC TRAILING x%"])
+def test_parse_alert_rejects_invalid(text):
+    with pytest.raises(ValueError):
+        crypto2.parse_alert(text)
+
+
+def test_price_alert_already_past_target_ignores_opposite_move():
+    book = crypto2.SymbolAlerts('ETH', [make_alert(1, 'ETH', 105, True)])
+    assert book.evaluate(100.0, None) == []
+    fired = book.evaluate(106.0, None)
+    assert fired_ids(fired) == [1]
+    assert fired[0].price == 106.0
+    assert book.evaluate(110.0, None) == []
+
+
+def test_price_alert_below():
+    book = crypto2.SymbolAlerts('BTC', [make_alert(1, 'BTC', 90, False)])
+    assert book.evaluate(95.0, None) == []
+    assert fired_ids(book.evaluate(89.0, None)) == [1]
+
+
+def test_percent_alert_measures_from_first_price():
+    book = crypto2.SymbolAlerts('BTC', [make_alert(1, 'BTC', 5, True, 'percent'), make_alert(2, 'BTC', 5, False, 'percent')])
+    assert book.evaluate(100.0, None) == []
+    fired = book.evaluate(106.0, None)
+    assert fired_ids(fired) == [1]
+    assert fired[0].value == pytest.approx(6.0)
+    assert fired_ids(book.evaluate(94.0, None)) == [2]
+
+
+def test_trailing_alert_follows_peak():
+    book = crypto2.SymbolAlerts('BTC', [make_alert(1, 'BTC', 10, False, 'trailing')])
+    assert book.evaluate(100.0, None) == []
+    assert book.evaluate(120.0, None) == []
+    assert book.evaluate(109.0, None) == []
+    fired = book.evaluate(107.0, None)
+    assert fired_ids(fired) == [1]
+    assert fired[0].value == 120.0
+
+
+def test_volatility_alert_needs_24h_change():
+    book = crypto2.SymbolAlerts('BTC', [make_alert(1, 'BTC', 8, True, 'volatility')])
+    assert book.evaluate(100.0, None) == []
+    assert book.evaluate(100.0, -5.0) == []
+    assert fired_ids(book.evaluate(100.0, -9.0)) == [1]
+
+
+def test_portfolio_alert_ignores_unpriced_symbols():
+    holdings = [{'user_id': 2, 'crypto': 'BTC', 'total_quantity': 2.0},
+                {'user_id': 2, 'crypto': 'UNKNOWN', 'total_quantity': 5.0}]
+    portfolio = crypto2.PortfolioAlerts([make_alert(1, None, 150, True, 'portfolio', user_id=2)], holdings)
+    assert portfolio.evaluate({'BTC': (70.0, 0.0)}) == []
+    fired = portfolio.evaluate({'BTC': (80.0, 0.0)})
+    assert fired_ids(fired) == [1]
+    assert fired[0].value == 160.0
+
+
+def test_portfolio_alert_only_for_holders_of_updated_symbols():
+    holdings = [{'user_id': 1, 'crypto': 'BTC', 'total_quantity': 1.0},
+                {'user_id': 2, 'crypto': 'ETH', 'total_quantity': 1.0}]
+    alerts = [make_alert(1, None, 50, True, 'portfolio', user_id=1), make_alert(2, None, 50, True, 'portfolio', user_id=2)]
+    portfolio = crypto2.PortfolioAlerts(alerts, holdings)
+    assert fired_ids(portfolio.evaluate({'BTC': (100.0, 0.0)})) == [1]
+    assert fired_ids(portfolio.evaluate({'ETH': (100.0, 0.0)})) == [2]
+
+
+def test_edited_alert_reference_is_not_overwritten(db):
+    db.execute("INSERT INTO price_alerts (user_id, crypto, target_price, is_above, alert_type) VALUES (1, 'BTC', 10, 0, 'trailing')")
+    db.commit()
+    crypto2.load_alert_index()
+    crypto2.alert_index.process_ticks({'BTC': (100.0, 0.0)})
+    crypto2.alert_index.process_ticks({'BTC': (120.0, 0.0)})
+    crypto2.save_alert_references()
+    assert db.execute("SELECT reference_price FROM price_alerts").fetchone()[0] == 120.0
+
+    # Nuovo massimo non ancora salvato, poi l'utente modifica l'alert come fa process_edit_alert
+    crypto2.alert_index.process_ticks({'BTC': (130.0, 0.0)})
+    db.execute("UPDATE price_alerts SET target_price = 5, is_above = 1, alert_type = 'percent', reference_price = 200")
+    db.commit()
+    # Un salvataggio periodico non deve riscrivere il massimo del vecchio trailing stop
+    crypto2.save_alert_references()
+    crypto2.apply_alert_reload([(200.0, 1)])
+
+    assert tuple(db.execute("SELECT alert_type, reference_price FROM price_alerts").fetchone()) == ('percent', 200.0)
+    assert crypto2.alert_index.process_ticks({'BTC': (131.0, 0.0)}) == []
+    assert fired_ids(crypto2.alert_index.process_ticks({'BTC': (211.0, 0.0)})) == [1]
+
+
+def test_initial_reference_uses_latest_known_price(monkeypatch):
+    monkeypatch.setattr(crypto2, 'get_current_prices', lambda cryptos: {'BTC': (100.0, 1.0)})
+    assert crypto2.initial_reference('BTC', 'percent') == 100.0
+    assert crypto2.initial_reference('BTC', 'trailing') == 100.0
+    assert crypto2.initial_reference('BTC', 'price') is None
+
+    # CoinMarketCap non raggiungibile: si usa l'ultimo tick ricevuto
+    monkeypatch.setattr(crypto2, 'get_current_prices', lambda cryptos: {})
+    monkeypatch.setattr(crypto2.alert_index, 'last_price', lambda crypto: 95.0)
+    assert crypto2.initial_reference('BTC', 'percent') == 95.0
+
+
+@pytest.mark.parametrize('feeds', [{'pol'}, {'poll', 'simulated'}])
+def test_check_alert_feed_rejects_invalid_configuration(monkeypatch, feeds):
+    monkeypatch.setattr(crypto2, 'ALERT_FEEDS', feeds)
+    with pytest.raises(ValueError):
+        crypto2.check_alert_feed()
+
+
+
+# Rendering delle risposte: il testo deve restare quello dei comandi originali
+@pytest.fixture
+def rows():
+    today = date(2024, 1, 31)
+    return [crypto2.PortfolioRow('BTC', 0.5, 10000.0, '2024-01-01', 0.25, 30000.0, 2.5, today),
+            crypto2.PortfolioRow('MY_COIN', 100.0, 50.0, '2024-01-21 10:00:00', 0.0, 1.0, -5.0, today),
+            crypto2.PortfolioRow('DEAD', 10.0, 20.0, '31/12/2023', 10.0, None, None, today)]
+
+
+def test_render_balance(rows):
+    assert crypto2.render_balance(rows) == (
+        "📊 *Il tuo Portafoglio Crypto*\n\n"
+        "*BTC*:\n"
+        "Quantità: 0.5000\n"
+        "Valore attuale: $15000.00\n"
+        "Prezzo attuale: $30000.00\n"
+        "Variazione 24h: 2.50%\n"
+        "P/L: $5000.00 (50.00%)\n"
+        "Giorni di detenzione: 30\n\n"
+        "*MY\\_COIN*:\n"
+        "Quantità: 100.0000\n"
+        "Valore attuale: $100.00\n"
+        "Prezzo attuale: $1.00\n"
+        "Variazione 24h: -5.00%\n"
+        "P/L: $50.00 (100.00%)\n"
+        "Giorni di detenzione: 10\n\n"
+        "*📈 Performance totale del portafoglio*:\n"
+        "*Valore totale: $15100.00*\n"
+        "Costo totale: $10050.00\n"
+        "*P/L totale: $5050.00 (50.25%)*\n")
+
+
+def test_render_profit(rows):
+    assert crypto2.render_profit(rows) == (
+        "Profitto/Perdita:\n\n"
+        "BTC:\n"
+        "  Profitto/Perdita: $5000.00\n"
+        "  Percentuale: +50.00%\n\n"
+        "MY_COIN:\n"
+        "  Profitto/Perdita: $50.00\n"
+        "  Percentuale: +100.00%\n\n"
+        "DEAD: Prezzo non disponibile\n\n"
+        "Profitto/Perdita totale: $5050.00")
+
+
+def test_render_weekly(rows):
+    assert crypto2.render_weekly(rows) == (
+        "Confronto con 7 giorni fa:\n\n"
+        "BTC:\n"
+        "  7 giorni fa: 0.2500 ($7500.00)\n"
+        "  Oggi: 0.5000 ($15000.00)\n"
+        "  Differenza: $7500.00 (+100.00%)\n\n"
+        "MY_COIN:\n"
+        "  7 giorni fa: 0.0000 ($0.00)\n"
+        "  Oggi: 100.0000 ($100.00)\n"
+        "  Differenza: $100.00 (+0.00%)\n\n"
+        "DEAD: Prezzo non disponibile\n\n")
+
+
+def test_render_report(rows):
+    assert crypto2.render_report(rows) == (
+        "📊 *Resoconto del tuo Portafoglio*\n\n"
+        "*BTC*: $15000.00 ($365.85, 2.50%)\n"
+        "*MY\\_COIN*: $100.00 ($-5.26, -5.00%)\n"
+        "\n*Totale: $15100.00*\n"
+        "Variazione 24h: $360.59 (2.45%)")
+
+
+def test_render_history():
+    transactions = [{'date': '2024-01-01', 'quantity': 0.5, 'price': 20000.0}, {'date': '2024-01-15', 'quantity': -0.1, 'price': 25000.0}]
+    assert crypto2.render_history('BTC', transactions, 30000.0) == (
+        "Storico delle transazioni per BTC:\n\n"
+        "Data: 2024-01-01, Quantità: 0.5000, Prezzo: $20000.00\n"
+        "Data: 2024-01-15, Quantità: -0.1000, Prezzo: $25000.00\n"
+        "\nPrezzo attuale di BTC: $30000.00")
+    assert crypto2.render_history('BTC', transactions[:1], None) == (
+        "Storico delle transazioni per BTC:\n\n"
+        "Data: 2024-01-01, Quantità: 0.5000, Prezzo: $20000.00\n")
+
+
+def test_non_iso_purchase_date_only_affects_days_held(rows):
+    dated = crypto2.PortfolioRow('ETH', 1.0, 100.0, '31/12/2023', 1.0, 200.0, 0.0, date(2024, 1, 31))
+    assert dated.days_held == 'n/d'
+    assert "Giorni di detenzione: n/d" in crypto2.render_balance([dated])
+    assert "ETH:" in crypto2.render_profit([dated]) and "ETH:" in crypto2.render_weekly([dated])
+
+
+# Messaggi live
+def test_live_message_edited_only_on_change_and_deferred_after_429(db, monkeypatch):
+    db.execute("INSERT INTO transactions (user_id, crypto, quantity, price, date) VALUES (1, 'BTC', 1, 50, '2024-01-01')")
+    db.execute("INSERT INTO live_messages (chat_id, user_id, message_id, content_hash) VALUES (7, 1, 99, '')")
+    db.commit()
+    edits = []
+    responses = []
+
+    def edit_message_text(text, chat_id, message_id, parse_mode=None):
+        if responses:
+            raise responses.pop()
+        edits.append((chat_id, message_id))
+
+    monkeypatch.setattr(crypto2.bot, 'edit_message_text', edit_message_text)
+    monkeypatch.setattr(crypto2, 'LIVE_EDIT_INTERVAL', 0)
+    monkeypatch.setitem(crypto2.live_retry_at, 7, 0)
+
+    crypto2.refresh_live_messages({'BTC': (100.0, 1.0)})
+    crypto2.refresh_live_messages({'BTC': (100.0, 1.0)})
+    assert edits == [(7, 99)]
+
+    # Richiesta dei prezzi fallita: il messaggio non viene svuotato
+    crypto2.refresh_live_messages({})
+    assert edits == [(7, 99)]
+
+    responses.append(crypto2.ApiTelegramException('editMessageText', None, {
+        'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 60}}))
+    crypto2.refresh_live_messages({'BTC': (110.0, 1.0)})
+    crypto2.refresh_live_messages({'BTC': (110.0, 1.0)})
+    assert edits == [(7, 99)]
+    assert crypto2.live_retry_at[7] > crypto2.monotonic()
+
+
+# Compattazione
+PRICES = {'BTC': (100.0, 2.0), 'ETH': (10.0, -1.0), 'SOL': (5.0, 0.0)}
+
+
+def portfolio_snapshot(user_id):
+    return sorted((row.crypto, round(row.quantity, 9), round(row.value, 6), round(row.profit_loss, 6), row.first_purchase_date,
+                   round(row.value_7_days_ago, 6)) for row in crypto2.load_portfolio(user_id, PRICES))
+
+
+@pytest.fixture
+def ledger(db):
+    old = '2020-01-01'
+    recent = crypto2.datetime.now().date().isoformat()
+    rows = [(1, 'BTC', 1.0, 50.0, old), (1, 'BTC', 0.5, 80.0, '2020-06-01'), (1, 'BTC', 0.25, 90.0, recent),
+            (1, 'ETH', 2.0, 5.0, old), (1, 'ETH', -2.0, 8.0, '2020-02-01'),
+            (1, 'SOL', 10.0, 3.0, recent), (2, 'BTC', 3.0, 20.0, old)]
+    db.executemany("INSERT INTO transactions (user_id, crypto, quantity, price, date) VALUES (?, ?, ?, ?, ?)", rows)
+    db.commit()
+    return db
+
+
+def test_compaction_keeps_portfolio(ledger):
+    before = portfolio_snapshot(1), portfolio_snapshot(2)
+    assert crypto2.compact_transactions() == 5
+    assert (portfolio_snapshot(1), portfolio_snapshot(2)) == before
+    assert ledger.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] == 2
+    assert ledger.execute("SELECT COUNT(*) FROM all_transactions").fetchone()[0] == 7
+
+
+def test_delete_and_update_archived_transaction(ledger):
+    crypto2.compact_transactions()
+    archived_id = ledger.execute("SELECT id FROM transactions_archive WHERE user_id = 1 AND crypto = 'BTC' AND price = 80").fetchone()[0]
+
+    crypto2.delete_transaction(1, archived_id)
+    btc = next(row for row in crypto2.load_portfolio(1, PRICES) if row.crypto == 'BTC')
+    assert btc.quantity == pytest.approx(1.25)
+    assert btc.cost == pytest.approx(50.0 + 22.5)
+
+    first_id = ledger.execute("SELECT id FROM transactions_archive WHERE user_id = 1 AND crypto = 'BTC'").fetchone()[0]
+    crypto2.update_transaction(1, first_id, 'SOL', 2.0, 4.0, crypto2.datetime.now().date())
+    assert ledger.execute("SELECT COUNT(*) FROM opening_balances WHERE user_id = 1 AND crypto = 'BTC'").fetchone()[0] == 0
+    assert ledger.execute("SELECT crypto FROM transactions WHERE id = ?", (first_id,)).fetchone()[0] == 'SOL'
+    holdings = {row.crypto: row.quantity for row in crypto2.load_portfolio(1, PRICES)}
+    assert holdings['BTC'] == pytest.approx(0.25)
+    assert holdings['SOL'] == pytest.approx(12.0)
+
+    # Le transazioni di altri utenti non vengono toccate
+    other_id = ledger.execute("SELECT id FROM all_transactions WHERE user_id = 2").fetchone()[0]
+    crypto2.delete_transaction(1, other_id)
+    assert portfolio_snapshot(2)[0][1] == 3.0
+
+
+def test_failed_notification_rearms_alert_and_keeps_batch(db, monkeypatch):
+    db.executemany("INSERT INTO price_alerts (user_id, crypto, target_price, is_above, alert_type) VALUES (?, 'BTC', 100, 1, 'price')",
+                   [(1,), (2,), (3,)])
+    db.commit()
+    crypto2.load_alert_index()
+    sent = []
+
+    def send_message(user_id, text):
+        if user_id == 1:
+            raise crypto2.ApiTelegramException('sendMessage', None, {
+                'error_code': 429, 'description': 'Too Many Requests', 'parameters': {'retry_after': 60}})
+        if user_id == 2:
+            raise crypto2.requests.exceptions.ConnectionError('rete non disponibile')
+        sent.append(user_id)
+
+    monkeypatch.setattr(crypto2.bot, 'send_message', send_message)
+    monkeypatch.setattr(crypto2, 'ALERT_SEND_INTERVAL', 0)
+    monkeypatch.setattr(crypto2, 'alert_retry_at', {})
+
+    crypto2.notify_fired_alerts(crypto2.alert_index.process_ticks({'BTC': (110.0, 0.0)}))
+    assert sent == [3]
+    assert [row[0] for row in db.execute("SELECT user_id FROM price_alerts ORDER BY user_id")] == [1, 2]
+
+    # Gli alert non consegnati scattano di nuovo; l'utente 1 resta in attesa dopo il 429
+    assert sorted(alert.user_id for alert in crypto2.alert_index.process_ticks({'BTC': (111.0, 0.0)})) == [1, 2]
+
+
+def test_transaction_change_reloads_only_that_users_portfolio_holdings(db):
+    while not crypto2.price_ticks.empty():
+        crypto2.price_ticks.get_nowait()
+    db.execute("INSERT INTO transactions (user_id, crypto, quantity, price, date) VALUES (1, 'BTC', 1, 50, '2024-01-01')")
+    db.execute("INSERT INTO price_alerts (user_id, crypto, target_price, is_above, alert_type) VALUES (1, NULL, 150, 1, 'portfolio')")
+    db.execute("INSERT INTO price_alerts (user_id, crypto, target_price, is_above, alert_type) VALUES (2, 'BTC', 200, 1, 'price')")
+    db.commit()
+    crypto2.load_alert_index()
+    books = crypto2.alert_index._books
+    assert crypto2.alert_index.process_ticks({'BTC': (100.0, 0.0), 'ETH': (10.0, 0.0)}) == []
+
+    crypto2.mark_transactions_changed(2)
+    assert crypto2.price_ticks.empty()
+
+    db.execute("INSERT INTO transactions (user_id, crypto, quantity, price, date) VALUES (1, 'ETH', 10, 5, '2024-01-01')")
+    db.commit()
+    crypto2.mark_transactions_changed(1)
+    kind, user_id = crypto2.price_ticks.get_nowait()
+    assert (kind, user_id) == (crypto2.RELOAD_HOLDINGS, 1)
+    crypto2.load_portfolio_holdings(user_id)
+
+    assert crypto2.alert_index._books is books
+    fired = crypto2.alert_index.process_ticks({'BTC': (100.0, 0.0)})
+    assert fired_ids(fired) == [1]
+    assert fired[0].value == 200.0
+
+
+# Cache dei grafici
+class FakeExecutor:
+    """Sostituisce il pool di processi: i future restano in attesa finché il test non li completa."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, render, *data):
+        future = Future()
+        self.submitted.append(future)
+        return future
+
+
+@pytest.fixture
+def chart_executor(monkeypatch):
+    executor = FakeExecutor()
+    monkeypatch.setattr(crypto2, 'chart_executor', executor)
+    monkeypatch.setattr(crypto2, 'chart_cache', OrderedDict())
+    monkeypatch.setattr(crypto2, 'transaction_versions', {})
+    monkeypatch.setattr(crypto2, 'price_cache', {'BTC': (10.0, (100.0, 1.0))})
+    return executor
+
+
+def request_chart():
+    return crypto2.get_chart(1, 'allocation', ['BTC'], crypto2.charts.render_allocation_chart, ('BTC',), (100.0,))
+
+
+def test_chart_cache_shares_identical_requests(chart_executor):
+    first = request_chart()
+    assert request_chart() is first
+    assert len(chart_executor.submitted) == 1
+
+
+def test_chart_cache_key_follows_transactions_and_prices(chart_executor):
+    first = request_chart()
+    crypto2.mark_transactions_changed(1)
+    second = request_chart()
+    assert second is not first
+
+    crypto2.price_cache['BTC'] = (20.0, (110.0, 1.0))
+    assert request_chart() is not second
+    assert len(chart_executor.submitted) == 3
+
+
+def test_failed_chart_render_is_not_cached(chart_executor):
+    failed = request_chart()
+    failed.set_exception(RuntimeError('rendering fallito'))
+    assert not crypto2.chart_cache
+
+    retried = request_chart()
+    assert retried is not failed
+    retried.set_result(b'png')
+    assert request_chart() is retried
+
+
+def test_compaction_keeps_weekly_window(ledger, monkeypatch):
+    # COMPACTION_KEEP_DAYS viene limitato all'avvio; qui si verifica il valore minimo
+    monkeypatch.setattr(crypto2, 'COMPACTION_KEEP_DAYS', crypto2.COMPACTION_CLOSED_AFTER_DAYS)
+    recent = (crypto2.datetime.now().date() - crypto2.timedelta(days=3)).isoformat()
+    ledger.execute("INSERT INTO transactions (user_id, crypto, quantity, price, date) VALUES (1, 'BTC', 1, 95, ?)", (recent,))
+    ledger.commit()
+    before = portfolio_snapshot(1)
+    crypto2.compact_transactions()
+    assert portfolio_snapshot(1) == before
+    assert ledger.execute("SELECT COUNT(*) FROM transactions WHERE date = ?", (recent,)).fetchone()[0] == 1